@@ -1,4 +1,63 @@
 {% extends 'base.tpl' %}
 {% block content %}
+    <section>
+        <h2>Summary</h2>
+        <table>
+            <tr><td>Directory</td><td>{{ result.dirpath }}</td></tr>
+            <tr><td>File Count</td><td>{{ file_count }}</td></tr>
+            <tr><td>Pass Count</td><td>{{ pass_count }}</td></tr>
+            <tr><td>Fail Count</td><td>{{ fail_count }}</td></tr>
+            <tr><td>Dupe Count</td><td>{{ dupe_count }}</td></tr>
+            <tr><td>Skip Count</td><td>{{ skip_count }}</td></tr>
+        </table>
+    </section>
 
-{% endblock %}
\ No newline at end of file
+    <section>
+        <h2>Passed</h2>
+        <ul>
+        {%- for name in result.passed %}
+            <li>{{ name }}</li>
+        {%- else %}
+            <li>-</li>
+        {%- endfor %}
+        </ul>
+    </section>
+
+    <section>
+        <h2>Failed</h2>
+        <ul>
+        {%- for name in result.failed %}
+            <li>{{ name }}</li>
+        {%- else %}
+            <li>-</li>
+        {%- endfor %}
+        </ul>
+    </section>
+
+    <section>
+        <h2>Errors</h2>
+        <table>
+            <tr><th>File</th><th>SMS #</th><th>Error</th></tr>
+        {%- for error in result.errors %}
+            <tr><td>{{ error.filename or '-' }}</td><td>{{ error.smsno if error.smsno is not none else '-' }}</td><td>{{ error.error }}</td></tr>
+        {%- else %}
+            <tr><td>-</td><td>-</td><td>-</td></tr>
+        {%- endfor %}
+        </table>
+    </section>
+    {%- if stages is not none %}
+
+    <section>
+        <h2>Timings</h2>
+        <table>
+            <tr><th>Stage</th><th>Calls</th><th>Wall (s)</th><th>CPU (s)</th><th>Bytes</th></tr>
+        {%- for x in stages %}
+            <tr><td>{{ x.stage }}</td><td>{{ x.calls }}</td><td>{{ '%.3f'|format(x.wall) }}</td><td>{{ '%.3f'|format(x.cpu) }}</td><td>{{ x.bytes }}</td></tr>
+        {%- endfor %}
+        </table>
+        {%- if peak_memory is not none %}
+        <p>Peak Traced Memory: {{ peak_memory }} bytes</p>
+        {%- endif %}
+    </section>
+    {%- endif %}
+{% endblock %}
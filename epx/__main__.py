@@ -0,0 +1,9 @@
+"""
+Runs the ePinXtractr command-line interface.
+"""
+import sys
+
+from epx.cli import main
+
+
+sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Defines the benchmark suite for ePinXtractr along with a generator of
+synthetic SMS Backup & Restore corpora to run it against.
+
+Each benchmark case runs within a fresh process so its peak RSS is not
+skewed by the cases before it. Results can be saved as a baseline and
+later runs compared against it to flag regressions:
+
+    python -m epx.bench --save-baseline bench.json
+    python -m epx.bench --baseline bench.json
+
+A realistic mixed corpus is had with `--noise` and `--malformed`, the
+shares of personal and of malformed ePin messages; runs over a corpus
+with noise skip it with the default sms filter as a real run would.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from xml.sax.saxutils import quoteattr
+
+from epx.core import EPin, Packt, EPinBatch, SNGen, EPXEngine, SmsFilter
+
+
+
+SMS_HEADER = (
+    "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n"
+    "<?xml-stylesheet type=\"text/xsl\" href=\"sms.xsl\"?>\n"
+    "<smses count=\"%d\">\n")
+SMS_FOOTER = "</smses>"
+SMS_FORMAT = (
+    "  <sms protocol=\"0\" address=%(address)s date=\"%(date)d\" type=\"1\" "
+    "subject=\"null\" body=%(body)s toa=\"null\" sc_toa=\"null\" "
+    "service_center=\"+2348020005009\" read=\"1\" status=\"-1\" locked=\"0\" "
+    "date_sent=\"null\" readable_date=\"null\" contact_name=\"(Unknown)\" />\n")
+
+EPIN_BODY_FORMAT = (
+    "Msg:ERC PIN(s):%s, Value:%d Qty:%d To recharge Dial *126*PIN# for voice "
+    "or *143*PIN# for data & press OK")
+NOISE_BODIES = (
+    "Hi, are we still on for tonight?",
+    "Your account has been credited with NGN5,000.00. Bal: NGN12,340.50",
+    "Call me when you get this please",
+    "Dear customer, your data bundle expires tomorrow. Dial *141# to renew.",
+)
+MALFORMED_BODY_FORMAT = "Msg:ERC PIN(s):%s Value:%d To recharge Dial *126*PIN#"
+VALUES = (100, 200, 400, 500, 1000, 1500)
+TOLERANCE = 0.10
+
+
+
+def make_pins(rng, count):
+    return [str(rng.randrange(10 ** 15, 10 ** 16)) for i in range(count)]
+
+
+def make_body(rng, pins=5, noise=0.0, malformed=0.0):
+    """Returns a message body which is an ePin message with `pins` pins, a
+    personal message with a probability of `noise` or a malformed ePin
+    message with a probability of `malformed`.
+    """
+    roll = rng.random()
+    if roll < noise:
+        return rng.choice(NOISE_BODIES), 'Friend'
+
+    value = rng.choice(VALUES)
+    numbers = ','.join(make_pins(rng, pins))
+    if roll < noise + malformed:
+        return MALFORMED_BODY_FORMAT % (numbers, value), 'AirtelERC'
+    return EPIN_BODY_FORMAT % (numbers, value, pins), 'AirtelERC'
+
+
+def generate_corpus(dirpath, files=10, messages=100, pins=5, noise=0.0,
+                    malformed=0.0, seed=0):
+    """Writes `files` backup files of `messages` sms each into dirpath and
+    returns their paths. Generation is deterministic for a given seed.
+    """
+    rng = random.Random(seed)
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+
+    paths, date = ([], 1470248525186)
+    for i in range(files):
+        path = os.path.join(dirpath, 'sms-%05d.xml' % i)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(SMS_HEADER % messages)
+            for j in range(messages):
+                body, address = make_body(rng, pins, noise, malformed)
+                date += rng.randrange(1000, 100000)
+                f.write(SMS_FORMAT % {
+                    'address': quoteattr(address), 'date': date,
+                    'body': quoteattr(body)})
+            f.write(SMS_FOOTER)
+        paths.append(path)
+    return paths
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes if the
+    platform reports it, else None.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def bench_process(files, messages, pins, workers=1, noise=0.0, malformed=0.0):
+    workdir = tempfile.mkdtemp(prefix='epx-bench-')
+    try:
+        generate_corpus(workdir, files, messages, pins, noise, malformed)
+        sms_filter = (SmsFilter() if noise else None)
+        engine = EPXEngine(workers=workers, sms_filter=sms_filter)
+        started = time.perf_counter()
+        result = engine.process(workdir)
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'seconds': elapsed,
+        'files_per_sec': (len(result.passed) + len(result.failed)) / elapsed,
+        'pins_per_sec': result.pins / elapsed,
+        'peak_rss': peak_rss()}
+
+
+def bench_packt_parse(files, messages, pins, workers=1, noise=0.0, malformed=0.0):
+    rng = random.Random(0)
+    bodies = [make_body(rng, pins, noise, malformed)[0]
+              for i in range(files * messages)]
+    started = time.perf_counter()
+    packts = Packt.parse_many(bodies, [])
+    elapsed = time.perf_counter() - started
+    return {
+        'seconds': elapsed,
+        'messages_per_sec': len(bodies) / elapsed,
+        'pins_per_sec': sum(x.count for x in packts) / elapsed,
+        'peak_rss': peak_rss()}
+
+
+def bench_format_epin(files, messages, pins, workers=1, noise=0.0, malformed=0.0):
+    rng = random.Random(0)
+    count = files * messages * pins
+    epins = [EPin(n, 100) for n in make_pins(rng, count)]
+    batches = [EPinBatch.from_packt(Packt(tuple(make_pins(rng, pins)), 100, pins))
+               for i in range(files * messages)]
+
+    engine = EPXEngine()
+    engine.sngen = SNGen()
+    started = time.perf_counter()
+    for epin in epins:
+        engine._format_epin(epin)
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for batch in batches:
+        engine._format_packt(batch)
+    batched = time.perf_counter() - started
+    return {
+        'seconds': single + batched,
+        'pins_per_sec': count / single,
+        'batch_pins_per_sec': count / batched,
+        'peak_rss': peak_rss()}
+
+
+CASES = {
+    'process': bench_process,
+    'packt_parse': bench_packt_parse,
+    'format_epin': bench_format_epin,
+}
+
+
+def run_suite(files=50, messages=200, pins=5, workers=1, cases=None, noise=0.0,
+              malformed=0.0):
+    """Runs the named cases, each within a fresh process, and returns their
+    metrics keyed by case name.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = {}
+    for name in (cases or sorted(CASES)):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(CASES[name], files, messages, pins, workers,
+                                     noise, malformed)
+            results[name] = future.result()
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Returns a list of (case, metric, baseline, current) for each metric
+    regressed beyond tolerance; lower throughput or higher peak RSS.
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, current in sorted(metrics.items()):
+            previous = baseline.get(name, {}).get(metric)
+            if previous is None or current is None or metric == 'seconds':
+                continue
+            if metric == 'peak_rss':
+                regressed = current > previous * (1 + tolerance)
+            else:
+                regressed = current < previous * (1 - tolerance)
+            if regressed:
+                regressions.append((name, metric, previous, current))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='epx.bench', description=(
+        "Benchmarks ePinXtractr against a synthetic SMS backup corpus."))
+    parser.add_argument('-f', '--files', type=int, default=50)
+    parser.add_argument('-m', '--messages', type=int, default=200,
+        help="messages per file")
+    parser.add_argument('-n', '--pins', type=int, default=5,
+        help="pins per message")
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('--noise', type=float, default=0.0,
+        help="share of personal messages in the corpus")
+    parser.add_argument('--malformed', type=float, default=0.0,
+        help="share of malformed epin messages in the corpus")
+    parser.add_argument('-c', '--case', action='append', choices=sorted(CASES),
+        help="case to run, can be repeated (default: all)")
+    parser.add_argument('--baseline', metavar='PATH',
+        help="compare results against the baseline at PATH")
+    parser.add_argument('--save-baseline', metavar='PATH',
+        help="save results as the baseline at PATH")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.files, args.messages, args.pins, args.workers,
+                        args.case, args.noise, args.malformed)
+    for name, metrics in sorted(results.items()):
+        print("%s:" % name)
+        for metric, value in sorted(metrics.items()):
+            print("  %-20s %s" % (metric, '-' if value is None else '%.2f' % value))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, metric, previous, current in regressions:
+            print("REGRESSION %s.%s: %.2f -> %.2f" % (name, metric, previous, current))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+Defines the headless command-line entry point for ePinXtractr.
+
+Only the core engine is imported here; GUI modules are never loaded and
+optional dependencies are imported only when the options needing them
+are used. Run with `python -m epx` or point a console script at
+`epx.cli:main`.
+"""
+import os
+import sys
+import signal
+import argparse
+import functools
+
+import epx
+from epx.core import EPXEngine, EPinWriter, ShardSink, HallowIndicator, \
+                     Progress, Instrumentation, SmsFilter, CancelToken
+from epx.report import REPORT_WRITERS, TextReport
+
+
+
+class ConsoleIndicator(HallowIndicator):
+    """Renders run progress onto a single, continually rewritten line."""
+
+    def __init__(self, stream=None):
+        self.stream = (stream or sys.stderr)
+        self._width = 0
+
+    def update(self, done=False, task_passed=None, level=0, stats=None):
+        line = Progress.describe(stats)
+        self.stream.write('\r' + line.ljust(self._width) + ('\n' if done else ''))
+        self.stream.flush()
+        self._width = len(line)
+
+
+SINK_FILE = 'file'
+SINK_SHARDS = 'shards'
+SINK_SQLITE = 'sqlite'
+SQLITE_FILENAME = 'epins.db'
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='epx', description=(
+            "Extracts ePin numbers from SMS Backup & Restore xml files."))
+    parser.add_argument('dirpaths', nargs='+', metavar='dirpath',
+        help="directory of backup files to process, can be repeated")
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+        help="directories processed at a time when given many (default: %(default)s)")
+    parser.add_argument('--summary', metavar='PATH',
+        help="write the combined summary of many directories to PATH")
+    parser.add_argument('-e', '--ext', default='.xml',
+        help="extension of target files (default: %(default)s)")
+    parser.add_argument('-o', '--output',
+        help="path for extracted epins, relative to dirpath (default: %s, or "
+             "%s with the sqlite sink)" % (EPXEngine.EPINS_FILENAME, SQLITE_FILENAME))
+    parser.add_argument('-s', '--sink', default=SINK_FILE,
+        choices=(SINK_FILE, SINK_SHARDS, SINK_SQLITE),
+        help="where epins go; one file, shard files or an sqlite database at "
+             "the output path (default: %(default)s)")
+    parser.add_argument('--shard-lines', type=int, metavar='N',
+        help="shard output every N lines rather than per epin value")
+    parser.add_argument('-z', '--gzip', action='store_true',
+        help="gzip-compress shard files as they are written")
+    parser.add_argument('-r', '--report', default=EPXEngine.REPORT_FILENAME,
+        help="path for the report, relative to dirpath (default: %(default)s)")
+    parser.add_argument('--report-format', choices=sorted(REPORT_WRITERS),
+        help="format of the report (default: implied by the report extension)")
+    parser.add_argument('-a', '--address', action='append',
+        help="only take sms from this sender address, can be repeated")
+    parser.add_argument('--sms-type', action='append',
+        help="only take sms of this type, e.g. 1 for received, can be repeated")
+    parser.add_argument('-m', '--marker', action='store_const', const=SmsFilter.MARKER,
+        help="skip sms without the %s marker in their body" % SmsFilter.MARKER)
+    parser.add_argument('--marker-text', dest='marker', metavar='TEXT',
+        help="skip sms without TEXT in their body")
+    parser.add_argument('-b', '--backend', default=EPXEngine.BACKEND_ETREE,
+        choices=EPXEngine.BACKENDS,
+        help="how backup files are parsed; mmap scans raw bytes without "
+             "building a tree (default: %(default)s)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help="number of processes parsing files (default: %(default)s)")
+    parser.add_argument('--no-compressed', dest='compressed', action='store_false',
+        help="skip compressed target files and zip archives")
+    parser.add_argument('-R', '--recursive', action='store_true',
+        help="process files within sub-directories as well")
+    parser.add_argument('--resume', action='store_true',
+        help="carry on from the journal of an earlier run, interrupted or "
+             "completed, keeping its output")
+    parser.add_argument('--pin-index', metavar='PATH',
+        help="index of emitted pins used to skip duplicates across runs")
+    parser.add_argument('--serial-store', metavar='PATH',
+        help="file serials are leased from so they stay unique across runs "
+             "and processes sharing it")
+    parser.add_argument('--flush-bytes', type=int, default=EPXEngine.FLUSH_BYTES,
+        help="output bytes buffered between flushes (default: %(default)s)")
+    parser.add_argument('--fsync', default=EPinWriter.FSYNC_NEVER,
+        choices=(EPinWriter.FSYNC_NEVER, EPinWriter.FSYNC_CLOSE,
+                 EPinWriter.FSYNC_FLUSH),
+        help="when output is synced to disk (default: %(default)s)")
+    parser.add_argument('-t', '--timings', action='store_true',
+        help="record per-stage timings into the report")
+    parser.add_argument('--trace-memory', action='store_true',
+        help="record peak traced memory into the report (slows the run); "
+             "with many directories the peak is that of the whole process")
+    parser.add_argument('--watch', action='store_true',
+        help="keep watching dirpath and process files as they arrive until "
+             "interrupted")
+    parser.add_argument('--interval', type=float, default=1.0,
+        help="seconds between polls in watch mode (default: %(default)s)")
+    parser.add_argument('--settle', type=float, default=2.0,
+        help="seconds a file must stop growing before it is processed in "
+             "watch mode (default: %(default)s)")
+    parser.add_argument('-p', '--progress', action='store_true',
+        help="show progress with throughput and eta on stderr")
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help="do not print the run summary")
+    parser.add_argument('--version', action='version',
+        version='%s %s' % (epx.__name__, epx.__version__))
+    return parser
+
+
+def build_sink(args):
+    if args.sink == SINK_SHARDS:
+        return functools.partial(
+            ShardSink, lines=args.shard_lines, compress=args.gzip,
+            buffer_size=args.flush_bytes, fsync=args.fsync)
+    if args.sink == SINK_SQLITE:
+        from epx.store import SqliteSink
+        return SqliteSink
+    return None
+
+
+def build_serial_store(args):
+    if args.serial_store:
+        from epx.store import SerialStore
+        return SerialStore(args.serial_store)
+    return None
+
+
+def build_engine(args, pin_index=None, serial_store=None):
+    instrumentation = None
+    if args.timings or args.trace_memory:
+        instrumentation = Instrumentation(trace_memory=args.trace_memory)
+    sms_filter = None
+    if args.address or args.sms_type or args.marker:
+        sms_filter = SmsFilter(args.address, args.sms_type, args.marker)
+
+    return EPXEngine(
+        target_ext=args.ext, workers=args.workers, pin_index=pin_index,
+        resume=args.resume, flush_bytes=args.flush_bytes, fsync=args.fsync,
+        recursive=args.recursive, epins_filename=args.output,
+        report_filename=args.report, report_format=args.report_format,
+        instrumentation=instrumentation, sms_filter=sms_filter,
+        backend=args.backend, compressed=args.compressed, sink=build_sink(args),
+        serial_store=serial_store)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.output is None:
+        args.output = (SQLITE_FILENAME if args.sink == SINK_SQLITE
+                       else EPXEngine.EPINS_FILENAME)
+    if len(args.dirpaths) > 1:
+        if args.watch:
+            parser.error("--watch takes a single directory")
+        if args.pin_index and args.jobs > 1:
+            parser.error("--pin-index needs --jobs 1 when given many directories")
+        if os.path.isabs(args.output) or os.path.isabs(args.report):
+            parser.error("output and report paths must be relative when given "
+                         "many directories")
+        return schedule(args)
+    
+    args.dirpath = args.dirpaths[0]
+    pin_index = None
+    if args.pin_index:
+        from epx.store import PinIndex
+        pin_index = PinIndex(args.pin_index)
+
+    engine = build_engine(args, pin_index, build_serial_store(args))
+    if args.watch:
+        try:
+            return watch(engine, args)
+        finally:
+            if pin_index is not None:
+                pin_index.close()
+    
+    try:
+        indicator = ConsoleIndicator() if args.progress else None
+        result = engine.process(args.dirpath, indicator)
+        engine.write_report(result)
+    except ValueError as ex:
+        print("epx: error: %s" % ex, file=sys.stderr)
+        return 2
+    finally:
+        if pin_index is not None:
+            pin_index.close()
+
+    if not args.quiet:
+        print("passed: %s / failed: %s / duplicates: %s / skipped: %s" % (
+            len(result.passed), len(result.failed), result.duplicates,
+            result.skipped))
+    return 1 if result.failed else 0
+
+
+def trap_signals(cancel):
+    """Has interrupts cancel the token rather than abort the run and returns
+    the handlers replaced, to be put back with `restore_signals`.
+    """
+    handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        handlers[signum] = signal.signal(signum, lambda *args: cancel.cancel())
+    return handlers
+
+
+def restore_signals(handlers):
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def watch(engine, args):
+    # interrupts stop the watch after the batch at hand rather than abort it
+    cancel = CancelToken()
+    handlers = trap_signals(cancel)
+    
+    def on_batch(result):
+        if not args.quiet:
+            print("batch: passed: %s / failed: %s / duplicates: %s / skipped: %s" % (
+                len(result.passed), len(result.failed), result.duplicates,
+                result.skipped), flush=True)
+    
+    try:
+        indicator = ConsoleIndicator() if args.progress else None
+        totals = engine.watch(args.dirpath, args.interval, args.settle,
+                              indicator, cancel, on_batch)
+    except ValueError as ex:
+        print("epx: error: %s" % ex, file=sys.stderr)
+        return 2
+    finally:
+        restore_signals(handlers)
+    
+    if not args.quiet:
+        print("passed: %s / failed: %s / duplicates: %s / skipped: %s" % (
+            totals.passed, totals.failed, totals.duplicates, totals.skipped))
+    return 1 if totals.failed else 0
+
+
+def schedule(args):
+    from epx.scheduler import Scheduler
+    
+    pin_index = None
+    if args.pin_index:
+        from epx.store import PinIndex
+        pin_index = PinIndex(args.pin_index)
+    
+    def on_done(summary):
+        if not args.quiet:
+            print("%s: passed: %s / failed: %s / duplicates: %s / skipped: %s%s" % (
+                summary.dirpath, summary.passed, summary.failed, summary.duplicates,
+                summary.skipped, (" / error: %s" % summary.error) if summary.error else ''),
+                flush=True)
+    
+    # interrupts stop the directories at hand and skip those still queued
+    cancel = CancelToken()
+    handlers = trap_signals(cancel)
+    try:
+        scheduler = Scheduler(functools.partial(
+            build_engine, args, pin_index, build_serial_store(args)), args.jobs)
+        summary = scheduler.run(args.dirpaths, cancel=cancel, on_done=on_done)
+    except ValueError as ex:
+        print("epx: error: %s" % ex, file=sys.stderr)
+        return 2
+    finally:
+        restore_signals(handlers)
+        if pin_index is not None:
+            pin_index.close()
+    
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            TextReport().write_summary(summary, f)
+    if not args.quiet:
+        TextReport().write_summary(summary, sys.stdout)
+    if summary.errors:
+        return 2
+    return 1 if summary.failed else 0
@@ -1,16 +1,25 @@
 """
 Defines the core objects for ePinXtractr.
 """
-import sys
+import re
 import json
+import mmap
+import time
+import queue
 import shutil
 import os.path
+import threading
+from array import array
+from itertools import chain
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from collections import deque
 from collections import namedtuple
 
 from dolfin import Storage as _ 
 
+from epx.report import REPORT_WRITERS, TextReport, report_format
+
 
 
 class EPin(namedtuple('EPin', 'number, value')):
@@ -49,6 +58,8 @@ class Packt(namedtuple('Packt', 'pins, value, quantity')):
     """
 
     FIELD_LABELS = ("PIN(S)", "VALUE", "QTY")
+    PATTERN = re.compile(
+        r'PIN\(S\):([^ :]*) VALUE:([^ :]*) QTY:([^ :]*)(?: |$)', re.IGNORECASE)
 
     @property
     def count(self):
@@ -58,37 +69,290 @@ class Packt(namedtuple('Packt', 'pins, value, quantity')):
         for pin in self.pins:
             yield EPin(pin, self.value)
 
+    def __getnewargs__(self):
+        # __iter__ yields epins so the tuple fields are spelt out for pickling
+        return (self.pins, self.value, self.quantity)
+
     @staticmethod
     def parse(message):
-        message = (message or "").upper()
-        indexes = [message.find(x + ':') for x in Packt.FIELD_LABELS]
-
-        if not message or -1 in indexes:
-            raise ValueError("Message format is invalid.")
-        
-        record = message[indexes[0] : message.find(' ', indexes[-1])]
-        fields = record.strip().split(' ')
-        if not fields or len(fields) != 3:
+        message = (message or "")
+        match = Packt.PATTERN.search(message)
+        if not match:
+            # labels are checked only on failure to tell both errors apart
+            upper = message.upper()
+            if not message or -1 in [upper.find(x + ':') for x in Packt.FIELD_LABELS]:
+                raise ValueError("Message format is invalid.")
             raise ValueError("Record format in message is invalid.")
         
-        args = []
-        for i, label in enumerate(Packt.FIELD_LABELS):
-            parts = fields[i].split(':')
-            if not parts or len(parts) != 2 or parts[0] != label:
-                raise ValueError("Record format in message is invalid.")
+        pins, value, quantity = match.groups()
+        args = [tuple([x for x in pins.split(',') if x])]
+        for label, field_value in zip(Packt.FIELD_LABELS[1:], (value, quantity)):
+            try:
+                args.append(int(field_value))
+            except:
+                raise ValueError("Record field value is invalid: %s" % label)
+        return Packt(*args)
+    
+    @staticmethod
+    def parse_many(bodies, errors=None):
+        """Parses a batch of message bodies into a list of packts. Failures are
+        raised unless an `errors` list is provided in which case an entry of
+        (index, error) is appended for each failing body and parsing goes on.
+        """
+        packts, parse = ([], Packt.parse)
+        for i, body in enumerate(bodies):
+            try:
+                packts.append(parse(body))
+            except ValueError as ex:
+                if errors is None:
+                    raise
+                errors.append((i, str(ex)))
+        return packts
+
+
+class EPinBatch(namedtuple('EPinBatch', 'numbers, value')):
+    """Represents the epins of a packt in compact form with the pin numbers
+    held as 64-bit integers alongside the single value they all share. The
+    numbers are validated once for the whole batch on creation.
+    """
+
+    def __new__(cls, numbers, value):
+        if not EPin.is_valid_value(value):
+            raise ValueError("Invalid ePin value: %s" % value)
+        return super(EPinBatch, cls).__new__(cls, numbers, int(value))
+    
+    @classmethod
+    def from_packt(cls, packt):
+        pins = (packt.pins or ())
+        digits = ''.join(pins)
+        if (not (digits.isascii() and digits.isdigit())
+                or any(len(pin) != EPin.PIN_LENGTH for pin in pins)):
+            for pin in pins:
+                if not (pin.isascii() and EPin.is_valid_number(pin)):
+                    raise ValueError("Invalid ePin number: %s" % pin)
+        return cls(array('Q', map(int, pins)), packt.value)
+    
+    @property
+    def count(self):
+        return len(self.numbers)
+    
+    def pins(self):
+        """Returns an iterator over the zero-padded pin numbers."""
+        fmt = '%%0%dd' % EPin.PIN_LENGTH
+        return (fmt % n for n in self.numbers)
+    
+    def __iter__(self):
+        # numbers are already validated so the EPin checks are bypassed
+        value = self.value
+        for pin in self.pins():
+            yield tuple.__new__(EPin, (pin, value))
+    
+    def __getnewargs__(self):
+        return (self.numbers, self.value)
+
+
+class SmsFilter(object):
+    """Represents the checks deciding which sms within a backup are taken for
+    ePin messages. Messages can be limited to a set of sender addresses and of
+    sms types, and their body must carry the marker text, matched regardless of
+    case. Messages failing any check are skipped without being parsed.
+    """
+
+    MARKER = 'PIN(S):'
+
+    def __init__(self, addresses=None, types=None, marker=MARKER):
+        self.addresses = (frozenset(addresses) if addresses else None)
+        self.types = (frozenset(str(x) for x in types) if types else None)
+        self.marker = marker
+        self._pattern = None
+        if marker:
+            self._pattern = re.compile(re.escape(marker), re.IGNORECASE)
+    
+    def __repr__(self):
+        return 'SmsFilter(addresses=%r, types=%r, marker=%r)' % (
+            self.addresses, self.types, self.marker)
+    
+    def accepts(self, address, type, body):
+        if self.addresses is not None and address not in self.addresses:
+            return False
+        if self.types is not None and type not in self.types:
+            return False
+        if self._pattern is not None and not self._pattern.search(body or ''):
+            return False
+        return True
+
+
+class SmsScanner(object):
+    """Represents a scan over the raw bytes of a backup file for the address,
+    type and body attributes of its <sms> records. The file is memory-mapped
+    and no document tree gets built; only the matched attribute values are
+    decoded and have their entities expanded. Backups are taken to be utf-8
+    encoded as written by SMS Backup & Restore; records laid out otherwise are
+    still found, only through a slower path. Comments and CDATA sections are
+    skipped, but element nesting is not tracked: unlike an xml parser, which
+    only takes <sms> elements right under the root, any <sms> element found
+    is taken, as within an element other than the root. Such nesting is never
+    written by SMS Backup & Restore.
+    """
+
+    RECORD_PATTERN = re.compile(
+        rb'<sms [^>]*? address="([^"]*)"[^>]*? type="([^"]*)"[^>]*? body="([^"]*)"[^>]*>')
+    TAG_PATTERN = re.compile(
+        rb'<sms([ \t\r\n][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*)>')
+    ATTR_PATTERN = re.compile(
+        rb'([^ \t\r\n=/]+)[ \t\r\n]*=[ \t\r\n]*(?:"([^"]*)"|\'([^\']*)\')')
+    ATTR_SPACES = bytes.maketrans(b'\t\n\r', b'   ')
+    CHARREF_PATTERN = re.compile(r'&#([0-9]+|[xX][0-9a-fA-F]+);')
+    ROOT_PATTERN = re.compile(rb'<([^?!/ \t\r\n>]+)[^>]*?(/?)>')
+    SKIP_PATTERN = re.compile(rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>', re.DOTALL)
+    FAST_KEYS = (b' address="', b' type="', b' body="')
+    SPACES = (b' ', b'\t', b'\r', b'\n')
+    TAIL_SIZE = 4096
+
+    def __init__(self, smsfile):
+        self.smsfile = smsfile
+        self._offset = 0
+    
+    def __iter__(self):
+        smsfile, opened = (self.smsfile, False)
+        if isinstance(smsfile, str):
+            smsfile, opened = (open(smsfile, 'rb'), True)
+        
+        try:
+            try:
+                fileno = smsfile.fileno()
+            except (AttributeError, OSError):
+                # in-memory files are scanned as they are
+                data = smsfile.read()
+                yield from self._scan(data.encode('utf-8') if isinstance(data, str) else data)
+                return
             
-            field_value = parts[1]
-            if i == 0:
-                pins = tuple([x for x in field_value.split(',') if x])
-                args.append(pins)
-            else:
-                try:
-                    value = int(field_value)
-                    args.append(value)
-                except:
-                    raise Value("Record field value is invalid: %s" % parts[0])
+            if not os.fstat(fileno).st_size:
+                raise ValueError("Backup file is empty.")
+            with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as data:
+                yield from self._scan(data)
+        finally:
+            if opened:
+                smsfile.close()
+    
+    def tell(self):
+        """Returns the offset just past the last record scanned."""
+        return self._offset
+    
+    def _scan(self, data):
+        segments = self._segments(data)
+        for start, stop in segments:
+            yield from self._scan_segment(data, start, stop)
+        self._check_end(data, segments)
+    
+    def _segments(self, data):
+        # the ranges of data outside comments and cdata sections, which are
+        # rare enough to be looked for before matching them
+        if data.find(b'<!--') < 0 and data.find(b'<![CDATA[') < 0:
+            return [(0, len(data))]
         
-        return Packt(*args)
+        segments, pos = ([], 0)
+        for match in self.SKIP_PATTERN.finditer(data):
+            segments.append((pos, match.start()))
+            pos = match.end()
+        segments.append((pos, len(data)))
+        return segments
+    
+    def _scan_segment(self, data, pos, stop):
+        # records laid out as written by SMS Backup & Restore are matched in a
+        # single pass; any record found in between matches is scanned apart
+        find, decode = (data.find, self._decode)
+        for match in self.RECORD_PATTERN.finditer(data, pos, stop):
+            start = match.start()
+            if find(b'<sms', pos, start) >= 0:
+                yield from self._scan_range(data, pos, start)
+            self._offset = pos = match.end()
+            address, type, body = match.groups()
+            yield (decode(address), decode(type), decode(body))
+        yield from self._scan_range(data, pos, stop)
+    
+    def _check_end(self, data, segments):
+        # a backup cut short, as by an interrupted export, fails as it does
+        # with an xml parser rather than pass with the records it has
+        match = None
+        for start, stop in segments:
+            match = self.ROOT_PATTERN.search(data, start, stop)
+            if match is not None:
+                break
+        if match is None:
+            raise ValueError("No root element found in backup file.")
+        if match.group(2):
+            return
+        
+        tail = data[max(0, len(data) - self.TAIL_SIZE):].rstrip()
+        closing = re.compile(rb'</%s[ \t\r\n]*>\Z' % re.escape(match.group(1)))
+        if closing.search(tail) is None:
+            raise ValueError("Backup file is incomplete; no closing </%s> tag found."
+                             % match.group(1).decode('utf-8', 'replace'))
+    
+    def _scan_range(self, data, pos, stop):
+        find, decode = (data.find, self._decode)
+        while True:
+            start = find(b'<sms', pos, stop)
+            if start < 0:
+                break
+            pos = start + 4
+            if data[pos:pos + 1] not in self.SPACES:
+                continue
+            
+            # the first '>' closes the tag unless it sits within a quoted
+            # value; such tags and those quoted otherwise take the slow path
+            end = find(b'>', pos)
+            tag = data[pos:end]
+            values = None
+            if end > 0 and b"'" not in tag and not tag.count(b'"') % 2:
+                values = self._find_values(tag)
+            if values is None:
+                match = self.TAG_PATTERN.match(data, start)
+                if match is None:
+                    raise ValueError("Malformed sms record at offset %d." % start)
+                end = match.end() - 1
+                values = self._match_values(match.group(1))
+            
+            self._offset = pos = end + 1
+            yield tuple(map(decode, values))
+    
+    def _find_values(self, tag):
+        values = []
+        for key in self.FAST_KEYS:
+            i = tag.find(key)
+            if i < 0:
+                return None
+            i += len(key)
+            values.append(tag[i:tag.index(b'"', i)])
+        return values
+    
+    def _match_values(self, tag):
+        attrs = dict((name, dquoted or squoted) for name, dquoted, squoted
+                     in self.ATTR_PATTERN.findall(tag))
+        if b'body' not in attrs:
+            raise KeyError('body')
+        return (attrs.get(b'address'), attrs.get(b'type'), attrs[b'body'])
+    
+    def _decode(self, value):
+        # mirrors attribute value normalisation of an xml parser
+        if value is None:
+            return None
+        if b'\r' in value:
+            value = value.replace(b'\r\n', b'\n')
+        text = value.translate(self.ATTR_SPACES).decode('utf-8')
+        if '&' in text:
+            text = text.replace('&lt;', '<').replace('&gt;', '>')\
+                       .replace('&quot;', '"').replace('&apos;', "'")
+            if '&#' in text:
+                text = self.CHARREF_PATTERN.sub(self._charref, text)
+            text = text.replace('&amp;', '&')
+        return text
+    
+    @staticmethod
+    def _charref(match):
+        ref = match.group(1)
+        return chr(int(ref[1:], 16) if ref[0] in 'xX' else int(ref))
 
 
 class SNGen(object):
@@ -111,7 +375,10 @@ class SNGen(object):
         self._length = length
         self._current = None
         self._counter = 0
-        self._gen = None
+        
+        # prefix and padding are computed once and shared by all serials
+        self._prefix = self.timestamp.strftime(self.TIMESTAMP_FORMAT)
+        self._padding = length - self.TIMESTAMP_LENGTH
     
     @property
     def current(self):
@@ -120,23 +387,604 @@ class SNGen(object):
         return self._current
     
     def get(self):
-        return next(self.__iter__())
+        self._current = self._format(self._offset + self._counter)
+        self._counter += 1
+        return self._current
+    
+    def reserve(self, count):
+        """Claims the next `count` serials as a contiguous block and returns an
+        iterator over them. The serials match those that `count` successive
+        calls to `get` would have returned.
+        """
+        if count < 0:
+            raise ValueError("Reserve count cannot be negative.")
+        
+        start = self._offset + self._counter
+        self._counter += count
+        if count:
+            self._current = self._format(start + count - 1)
+        return map(self._format, range(start, start + count))
     
     def __iter__(self):
-        if not self._gen:
-            self._gen = self.__make_iterator()
-        return self._gen
+        while True:
+            yield self.get()
+    
+    def close(self):
+        """Gives up whatever serials are held but not yet handed out."""
+        pass
     
-    def __make_iterator(self):
-        tstamp_str = self.timestamp.strftime(self.TIMESTAMP_FORMAT)
-        pad_length = self._length - self.TIMESTAMP_LENGTH
-        sn_format = '{}{:0>%s}' % pad_length
+    def _format(self, number):
+        return self._prefix + str(number).zfill(self._padding)
+
+
+class LeasedSNGen(SNGen):
+    """Represents a serial number generator whose sequence numbers are drawn
+    from blocks leased from a persistent `store` rather than counted from an
+    offset, so serials stay unique across runs, restarts and processes which
+    share the store even when they start within the same second. Blocks hold
+    at least `block_size` numbers; the unused rest of the block at hand is
+    handed back to the store by `close`. Numbers never wrap around, so once
+    the store runs past those fitting within the serial length serials are
+    exhausted and `reserve` fails rather than hand out longer serials.
+    """
+
+    def __init__(self, store, timestamp=None, length=20, block_size=None):
+        super(LeasedSNGen, self).__init__(timestamp, 1, length)
+        self.store = store
+        self.block_size = (block_size or store.block_size)
+        self._limit = 10 ** self._padding
+        self._next = self._stop = 0
+    
+    def get(self):
+        return next(self.reserve(1))
+    
+    def reserve(self, count):
+        """Claims the next `count` serials and returns an iterator over them.
+        The serials are contiguous unless they span more than one lease.
+        """
+        if count < 0:
+            raise ValueError("Reserve count cannot be negative.")
+        
+        ranges = []
+        while count:
+            if self._next == self._stop:
+                self._next, self._stop = self.store.lease(max(count, self.block_size))
+                # numbers past the limit are of no use and are never handed out
+                self._stop = min(self._stop, self._limit)
+                if self._next >= self._stop:
+                    self._next = self._stop = 0
+                    raise ValueError("Serial numbers of length %s are exhausted."
+                                     % self._length)
+            stop = min(self._next + count, self._stop)
+            ranges.append(range(self._next, stop))
+            count -= stop - self._next
+            self._next = stop
+        
+        if not ranges:
+            return iter(())
+        self._current = self._format(ranges[-1][-1])
+        numbers = ranges[0] if len(ranges) == 1 else chain.from_iterable(ranges)
+        return map(self._format, numbers)
+    
+    def close(self):
+        """Hands the unused rest of the block at hand back to the store."""
+        if self._next < self._stop:
+            self.store.release(self._next, self._stop)
+        self._next = self._stop = 0
+
+
+class DirScanner(object):
+    """Represents a streaming scan of a directory for target files built on
+    os.scandir. Entries are gathered by a background thread so consumers can
+    start on the first file right away while `count` keeps growing until the
+    scan is `done`. Yielded names are relative to the scanned directory.
+    
+    With `compressed` set, target files compressed with gzip, bz2 or xz and
+    zip archives are matched as well.
+    
+    Failures to scan are noted in `errors` rather than raised so the files
+    found are still processed; a sub-directory which cannot be scanned is
+    skipped.
+    """
+
+    COMPRESSED_EXTS = ('.gz', '.bz2', '.xz')
+    ARCHIVE_EXTS = ('.zip',)
+
+    def __init__(self, dirpath, target_ext=None, recursive=False, exclude=(),
+                 compressed=False):
+        if not dirpath or not os.path.isdir(dirpath):
+            raise ValueError('Invalid directory path provided.')
+        
+        self.dirpath = dirpath
+        self.count = 0
+        self.done = False
+        self._target_ext = target_ext
+        self._compressed = compressed
+        self._recursive = recursive
+        self._exclude = set(exclude)
+        self._queue = None
+        self.errors = []
+    
+    def __iter__(self):
+        if self._queue is None:
+            self._queue = queue.Queue()
+            threading.Thread(target=self._scan, daemon=True).start()
         
         while True:
-            self._current = sn_format.format(
-                tstamp_str, self._offset + self._counter)
-            yield self._current
-            self._counter += 1
+            item = self._queue.get()
+            if item is None:
+                break
+            yield item
+    
+    def summary(self):
+        """Returns counts of sub-directories, files and target files found by a
+        single pass over the directory.
+        """
+        stats = _(dirs=0, files=0, targets=0)
+        for relpath, entry in self._walk(self.dirpath, ''):
+            if entry.is_dir():
+                stats.dirs += 1
+            else:
+                stats.files += 1
+                if self._is_target(entry.name):
+                    stats.targets += 1
+        return stats
+    
+    def _scan(self):
+        try:
+            for relpath, entry in self._walk(self.dirpath, ''):
+                if self._is_target(entry.name) and entry.is_file():
+                    self.count += 1
+                    self._queue.put(relpath)
+        except Exception as ex:
+            self.errors.append(str(ex))
+        finally:
+            self.done = True
+            self._queue.put(None)
+    
+    def _walk(self, dirpath, prefix):
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    relpath = prefix + entry.name
+                    if relpath in self._exclude:
+                        continue
+                    yield relpath, entry
+                    if self._recursive and entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, relpath + os.sep))
+        except OSError as ex:
+            if not prefix:
+                raise
+            self.errors.append("Unable to scan directory %s: %s" % (prefix[:-1], ex))
+        
+        for subdir, subprefix in subdirs:
+            for item in self._walk(subdir, subprefix):
+                yield item
+    
+    def _is_target(self, name):
+        if not self._target_ext or name.endswith(self._target_ext):
+            return True
+        if not self._compressed:
+            return False
+        
+        base, ext = os.path.splitext(name)
+        ext = ext.lower()
+        return (ext in self.ARCHIVE_EXTS or
+                (ext in self.COMPRESSED_EXTS and base.endswith(self._target_ext)))
+
+
+class DirWatcher(DirScanner):
+    """Represents a polling watch over a directory for new or changed target
+    files. The size and mtime of each file seen are indexed between polls and
+    a file is handed out once only after these stayed unchanged for `settle`
+    seconds, which leaves files still being written alone.
+    """
+
+    def __init__(self, dirpath, target_ext=None, recursive=False, exclude=(),
+                 compressed=False, settle=2.0):
+        super(DirWatcher, self).__init__(
+            dirpath, target_ext, recursive, exclude, compressed)
+        self.settle = settle
+        self._index = {}
+        self._handled = {}
+    
+    def poll(self, now=None):
+        """Returns the names of files which became ready since the last poll."""
+        now = (time.monotonic() if now is None else now)
+        index, handled, ready = ({}, {}, [])
+        self.errors = []
+        for relpath, signature in self._stat():
+            # handled files are not handed out again unless they change
+            if self._handled.get(relpath) == signature:
+                handled[relpath] = signature
+                continue
+            
+            previous = self._index.get(relpath)
+            since = (previous[1] if previous and previous[0] == signature else now)
+            if now - since >= self.settle:
+                handled[relpath] = signature
+                ready.append(relpath)
+            else:
+                index[relpath] = (signature, since)
+        
+        self._index, self._handled = (index, handled)
+        return sorted(ready)
+    
+    def skip(self, relpaths):
+        """Marks files as handled as they are now."""
+        relpaths = set(relpaths)
+        for relpath, signature in self._stat():
+            if relpath in relpaths:
+                self._handled[relpath] = signature
+    
+    def _stat(self):
+        for relpath, entry in self._walk(self.dirpath, ''):
+            if self._is_target(entry.name) and entry.is_file():
+                st = entry.stat()
+                yield relpath, (st.st_size, st.st_mtime_ns)
+
+
+class SpillList(object):
+    """Represents an append-only list which keeps at most `window` items in
+    memory. Once the window fills up its items get spilled as json lines into
+    an anonymous temporary file; iteration reads back the spilled items ahead
+    of those still in memory. Dict items are read back as storage objects.
+    """
+
+    def __init__(self, items=(), window=10000):
+        self.window = window
+        self._items = []
+        self._count = 0
+        self._file = None
+        self.extend(items)
+    
+    def __len__(self):
+        return self._count
+    
+    def __iter__(self):
+        if self._file is not None:
+            self._file.flush()
+            self._file.seek(0)
+            for line in self._file:
+                item = json.loads(line)
+                yield _(item) if isinstance(item, dict) else item
+            self._file.seek(0, os.SEEK_END)
+        for item in list(self._items):
+            yield item
+    
+    def __repr__(self):
+        return 'SpillList(%d items)' % self._count
+    
+    def append(self, item):
+        self._items.append(item)
+        self._count += 1
+        if len(self._items) >= self.window:
+            self._spill()
+    
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def _spill(self):
+        if self._file is None:
+            import tempfile
+            self._file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        # an iteration stopped early leaves the file positioned part way
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(''.join(json.dumps(x) + '\n' for x in self._items))
+        self._items = []
+
+
+class EPinWriter(object):
+    """Represents the output file for extracted epin lines. The file is kept
+    open for a whole run and written as a '.part' file which gets renamed into
+    place on close so readers never see a partially written output.
+    
+    This is the default output sink of the engine. A sink takes lines which
+    share an epin value with `write`, makes them durable with `flush` which
+    returns a json-serialisable checkpoint, rolls its output back to such a
+    checkpoint with `restore` when a run is resumed, removes the output of an
+    earlier run with `discard` and completes the output with `close`. Sink
+    factories are called with the output path, and with `append=True` as well
+    in watch mode.
+    
+    With `append` set lines are written straight into the output file after
+    whatever it already holds and nothing gets renamed, so output committed
+    earlier stays in place; watch mode appends to its output this way.
+    
+    With `compress` set the lines of each flush are written as a gzip member
+    so the file stays a valid gzip stream which can be cut at any checkpoint.
+    """
+
+    FSYNC_NEVER = 'never'
+    FSYNC_CLOSE = 'close'
+    FSYNC_FLUSH = 'flush'
+
+    def __init__(self, path, buffer_size=1 << 20, fsync=FSYNC_NEVER, compress=False,
+                 append=False):
+        if fsync not in (self.FSYNC_NEVER, self.FSYNC_CLOSE, self.FSYNC_FLUSH):
+            raise ValueError("Invalid fsync policy: %s" % fsync)
+        
+        self.path = path
+        self.part_path = path + '.part'
+        self._buffer_size = buffer_size
+        self._fsync = fsync
+        self._compress = compress
+        self._append = append
+        self._write_path = (path if append else self.part_path)
+        self._pending = []
+        self._file = None
+    
+    def write(self, lines, value=None):
+        if self._compress:
+            self._pending.extend(lines)
+            return
+        
+        if not self._file:
+            self._file = open(self._write_path, 'a', buffering=self._buffer_size)
+        
+        # writes straight into the file buffer avoid joining lines up front
+        write = self._file.write
+        for line in lines:
+            write(line)
+            write('\n')
+    
+    def flush(self):
+        """Flushes buffered lines and returns the size of the output so far."""
+        if self._pending:
+            self._write_member()
+        
+        if not self._file:
+            if os.path.exists(self._write_path):
+                return os.path.getsize(self._write_path)
+            return 0
+        
+        self._file.flush()
+        if self._fsync == self.FSYNC_FLUSH:
+            os.fsync(self._file.fileno())
+        return self._file.tell()
+    
+    def restore(self, offset):
+        """Cuts the output back to the size returned by an earlier flush."""
+        # output may have been renamed into place just before the crash, and
+        # appending output is cut in place so it never goes out of sight
+        if self._append:
+            if os.path.exists(self.part_path):
+                os.replace(self.part_path, self.path)
+        elif not os.path.exists(self.part_path) and os.path.exists(self.path):
+            os.replace(self.path, self.part_path)
+        if os.path.exists(self._write_path):
+            os.truncate(self._write_path, offset)
+    
+    def discard(self):
+        for path in (self.path, self.part_path):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except:
+                pass
+    
+    def close(self, commit=True):
+        if commit and self._pending:
+            self._write_member()
+        self._pending = []
+        if self._file:
+            self._file.flush()
+            if commit and self._fsync != self.FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        
+        if commit and not self._append and os.path.exists(self.part_path):
+            os.replace(self.part_path, self.path)
+    
+    def _write_member(self):
+        import gzip
+        
+        data = ''.join(x + '\n' for x in self._pending).encode('utf-8')
+        self._pending = []
+        if not self._file:
+            self._file = open(self._write_path, 'ab', buffering=self._buffer_size)
+        self._file.write(gzip.compress(data))
+
+
+class ShardSink(object):
+    """Represents output split over shard files, one per epin value or one per
+    `lines` lines when given. Shards are named after the output path, such as
+    epins-100.txt or epins-00001.txt, and each is an EPinWriter; `compress`
+    has them gzip-compressed as they are written with a '.gz' suffix added
+    and `append` has shards appended to in place.
+    """
+
+    def __init__(self, path, lines=None, compress=False, buffer_size=1 << 20,
+                 fsync=EPinWriter.FSYNC_NEVER, append=False):
+        if lines is not None and lines < 1:
+            raise ValueError("Invalid shard size: %s" % lines)
+        
+        self.path = path
+        self.lines = lines
+        self._stem, self._ext = os.path.splitext(path)
+        if compress:
+            self._ext += '.gz'
+        self._compress = compress
+        self._append = append
+        self._buffer_size = buffer_size
+        self._fsync = fsync
+        self._count = 0
+        self._writers = {}
+        if append:
+            # shards already on disk are reported by flush from the start
+            for path in self._existing():
+                self._writer(path)
+    
+    def shard_path(self, key):
+        return '%s-%s%s' % (self._stem, key, self._ext)
+    
+    def write(self, lines, value=None):
+        if not self.lines:
+            self._writer(self.shard_path(value)).write(lines)
+            return
+        
+        # a shard is closed off once full so only one is kept open at a time
+        start = 0
+        while start < len(lines):
+            index, used = divmod(self._count, self.lines)
+            stop = start + min(self.lines - used, len(lines) - start)
+            writer = self._writer(self.shard_path('%05d' % (index + 1)))
+            writer.write(lines[start:stop])
+            self._count += stop - start
+            start = stop
+            if not self._count % self.lines:
+                writer.flush()
+                writer.close(commit=False)
+    
+    def flush(self):
+        shards = dict((os.path.basename(path), writer.flush())
+                      for path, writer in self._writers.items())
+        return {'lines': self._count, 'shards': shards}
+    
+    def restore(self, checkpoint):
+        # shards created after the checkpoint are dropped altogether
+        self._count = checkpoint['lines']
+        shards = checkpoint['shards']
+        for path in self._existing():
+            name = os.path.basename(path)
+            if name in shards:
+                self._writer(path).restore(shards[name])
+            else:
+                EPinWriter(path).discard()
+    
+    def discard(self):
+        for path in self._existing():
+            EPinWriter(path).discard()
+    
+    def close(self, commit=True):
+        for writer in self._writers.values():
+            writer.close(commit)
+    
+    def _writer(self, path):
+        writer = self._writers.get(path)
+        if writer is None:
+            writer = self._writers[path] = EPinWriter(
+                path, self._buffer_size, self._fsync, self._compress,
+                self._append)
+        return writer
+    
+    def _existing(self):
+        # yields the paths of shards found on disk whether committed or not
+        dirpath, stem = os.path.split(self._stem)
+        pattern = re.compile(r'%s-\w+%s(?:\.part)?$' % (
+            re.escape(stem), re.escape(self._ext)))
+        paths = set()
+        with os.scandir(dirpath or '.') as it:
+            for entry in it:
+                if pattern.match(entry.name):
+                    name = entry.name
+                    if name.endswith('.part'):
+                        name = name[:-len('.part')]
+                    paths.add(os.path.join(dirpath, name))
+        return sorted(paths)
+
+
+class FileMover(object):
+    """Represents a background stage which relocates processed files into a
+    destination directory. Files are renamed when both directories share a
+    filesystem and copied then unlinked otherwise, using a pool of threads.
+    Failures are reported as error records with the name of the file.
+    """
+
+    def __init__(self, dirpath, dirdest, workers=4):
+        self.dirpath = dirpath
+        self.dirdest = dirdest
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+        self._errors = []
+        self._same_fs = None
+    
+    def submit(self, filenames):
+        if self._same_fs is None:
+            try:
+                if not os.path.exists(self.dirdest):
+                    os.mkdir(self.dirdest)
+                self._same_fs = (os.stat(self.dirpath).st_dev
+                                 == os.stat(self.dirdest).st_dev)
+            except Exception as ex:
+                err_msg = "Unable to create directory. (Error: %s)"
+                self._errors.append(_(filename=None, smsno=None, error=err_msg % ex))
+                return
+        
+        for f in filenames:
+            self._futures.append((f, self._executor.submit(self._move, f)))
+    
+    def collect(self, wait=False):
+        """Returns error records for completed moves which failed."""
+        errors, pending = (self._errors, [])
+        for f, future in self._futures:
+            if not wait and not future.done():
+                pending.append((f, future))
+                continue
+            ex = future.exception()
+            if ex is not None:
+                err_msg = "Unable to move file. (Error: %s)"
+                errors.append(_(filename=f, smsno=None, error=err_msg % ex))
+        
+        self._futures, self._errors = (pending, [])
+        return errors
+    
+    def close(self):
+        errors = self.collect(wait=True)
+        self._executor.shutdown()
+        return errors
+    
+    def _move(self, filename):
+        src = os.path.join(self.dirpath, filename)
+        dst = os.path.join(self.dirdest, filename)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            raise FileExistsError("Destination path '%s' already exists" % dst)
+        
+        if self._same_fs:
+            os.rename(src, dst)
+        else:
+            shutil.copy2(src, dst)
+            os.unlink(src)
+
+
+class ProcessCancelled(Exception):
+    """Raised within a run when cancellation has been requested."""
+
+
+class CancelToken(object):
+    """Represents a cooperative cancellation request shared between the thread
+    running an engine and the one wishing to stop it. The engine checks the
+    token between files and between the messages of a file.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+    
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+    
+    def cancel(self):
+        self._event.set()
+    
+    def check(self):
+        if self._event.is_set():
+            raise ProcessCancelled()
+    
+    def wait(self, timeout=None):
+        """Blocks until cancelled or timeout elapses; returns if cancelled."""
+        return self._event.wait(timeout)
 
 
 class HallowIndicator(object):
@@ -147,170 +995,838 @@ class HallowIndicator(object):
     def init(self, task_count=0, level=0):
         pass
     
-    def update(self, done=False, task_passed=None):
+    def update(self, done=False, task_passed=None, level=0, stats=None):
         pass
 
 
+class Progress(object):
+    """Represents the progress of a run tracked at two nested levels; over the
+    files of a directory and through the bytes of the file being parsed. The
+    counters are cheap to bump while deliveries to the indicator are limited
+    to one every `interval` seconds and carry derived throughput figures.
+    
+    Indicators whose `update` takes no `level` and `stats`, as written before
+    these were added, are updated as they always were; once per file with
+    only whether it passed, and never for progress within a file.
+    """
+
+    LEVEL_DIRECTORY = 0
+    LEVEL_FILE = 1
+    MESSAGE_STRIDE = 256
+
+    def __init__(self, indicator=None, interval=0.25):
+        self.indicator = (indicator or HallowIndicator())
+        self.interval = interval
+        self._legacy = not self._takes_stats(self.indicator)
+        self.stats = _(files=0, files_total=0, pins=0, messages=0, bytes=0,
+                       file_offset=0, file_size=0, elapsed=0.0, files_per_sec=0.0,
+                       pins_per_sec=0.0, bytes_per_sec=0.0, eta=None)
+        self._started = time.monotonic()
+        self._due = self._started
+    
+    def init(self, task_count):
+        self.stats.files_total = task_count
+        self.indicator.init(task_count=task_count, level=self.LEVEL_DIRECTORY)
+    
+    def message(self, offset, size):
+        """Notes the byte offset reached within the file being parsed."""
+        stats = self.stats
+        if self._legacy:
+            return
+        if stats.file_size != size:
+            stats.file_size = size
+            self.indicator.init(task_count=size, level=self.LEVEL_FILE)
+        stats.file_offset = offset
+        if time.monotonic() >= self._due:
+            self._deliver(self.LEVEL_FILE)
+    
+    def file_done(self, passed, pins, messages, nbytes):
+        stats = self.stats
+        stats.files += 1
+        stats.pins += pins
+        stats.messages += messages
+        stats.bytes += nbytes
+        if self._legacy:
+            self.indicator.update(done=False, task_passed=passed)
+        elif time.monotonic() >= self._due:
+            self._deliver(self.LEVEL_DIRECTORY, task_passed=passed)
+    
+    def finish(self):
+        if self._legacy:
+            self.indicator.update(done=True)
+            return
+        self._deliver(self.LEVEL_DIRECTORY, done=True)
+    
+    @staticmethod
+    def describe(stats):
+        """Returns a one line summary of the stats for display."""
+        eta = '--:--'
+        if stats.eta is not None:
+            minutes, seconds = divmod(int(stats.eta), 60)
+            eta = '%02d:%02d' % (minutes, seconds)
+        return "%s/%s files | %.1f files/s | %.0f pins/s | %.1f MB/s | eta %s" % (
+            stats.files, stats.files_total, stats.files_per_sec,
+            stats.pins_per_sec, stats.bytes_per_sec / 1e6, eta)
+    
+    def _deliver(self, level, done=False, task_passed=None):
+        now, stats = (time.monotonic(), self.stats)
+        elapsed = stats.elapsed = max(now - self._started, 1e-9)
+        stats.files_per_sec = stats.files / elapsed
+        stats.pins_per_sec = stats.pins / elapsed
+        stats.bytes_per_sec = stats.bytes / elapsed
+        
+        remaining = max(stats.files_total - stats.files, 0)
+        stats.eta = (remaining / stats.files_per_sec) if stats.files_per_sec else None
+        if done:
+            stats.eta = 0
+        
+        self._due = now + self.interval
+        self.indicator.update(done=done, task_passed=task_passed, level=level,
+                              stats=stats)
+    
+    @staticmethod
+    def _takes_stats(indicator):
+        import inspect
+        try:
+            params = inspect.signature(indicator.update).parameters.values()
+        except (TypeError, ValueError):
+            return True
+        return any(x.kind == x.VAR_KEYWORD or x.name == 'stats' for x in params)
+
+
+class Instrumentation(object):
+    """Represents optional instrumentation of a run which records the wall and
+    cpu time, call count and bytes handled by each stage of the pipeline, and
+    optionally the peak memory traced over the run. Hooks are callables taking
+    `(stage, wall, cpu, nbytes)` invoked as each measurement gets recorded, to
+    feed external profilers.
+    
+    Memory is traced process-wide; runs overlapping within a process, such as
+    those of the scheduler, share the tracing which is kept on until the last
+    of them stops, so each reports the peak of the whole process.
+    """
+
+    STAGES = ('xml', 'packt', 'dedupe', 'format', 'write', 'move')
+    _trace_lock = threading.Lock()
+    _trace_count = 0
+
+    def __init__(self, trace_memory=False, hooks=()):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks)
+        self.stages = {}
+        self.peak_memory = None
+    
+    @staticmethod
+    def clock():
+        return (time.perf_counter(), time.process_time())
+    
+    def record(self, stage, wall, cpu, calls=1, nbytes=0):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0, 0.0, 0]
+        entry[0] += calls
+        entry[1] += wall
+        entry[2] += cpu
+        entry[3] += nbytes
+        for hook in self.hooks:
+            hook(stage, wall, cpu, nbytes)
+    
+    def record_since(self, stage, mark, calls=1, nbytes=0):
+        wall, cpu = self.clock()
+        self.record(stage, wall - mark[0], cpu - mark[1], calls, nbytes)
+    
+    def merge(self, stages):
+        for stage, (calls, wall, cpu, nbytes) in stages.items():
+            self.record(stage, wall, cpu, calls, nbytes)
+    
+    def start(self):
+        self.stages, self.peak_memory = ({}, None)
+        if self.trace_memory:
+            import tracemalloc
+            with Instrumentation._trace_lock:
+                if not Instrumentation._trace_count:
+                    tracemalloc.start()
+                Instrumentation._trace_count += 1
+    
+    def stop(self):
+        if self.trace_memory:
+            import tracemalloc
+            with Instrumentation._trace_lock:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                Instrumentation._trace_count -= 1
+                if not Instrumentation._trace_count:
+                    tracemalloc.stop()
+    
+    def summary(self):
+        """Returns the recorded stages in pipeline order."""
+        names = [x for x in self.STAGES if x in self.stages]
+        names += sorted(x for x in self.stages if x not in self.STAGES)
+        return [_(stage=x, calls=self.stages[x][0], wall=self.stages[x][1],
+                  cpu=self.stages[x][2], bytes=self.stages[x][3]) for x in names]
+
+
 class EPXEngine(object):
 
     EPIN_LINE_FORMAT = "{number},{serial},{value},00000,{today}"
     REPORT_FILENAME = 'result.txt'
     EPINS_FILENAME = 'epins.txt'
+    JOURNAL_FILENAME = '.epx-journal'
+    FLUSH_BYTES = 1 << 20
+    PROGRESS_INTERVAL = 0.25
+    CANCEL_INTERVAL = 0.1
+    RESULT_WINDOW = 10000
+    BACKEND_ETREE = 'etree'
+    BACKEND_MMAP = 'mmap'
+    BACKENDS = (BACKEND_ETREE, BACKEND_MMAP)
 
-    def __init__(self, target_ext='.xml'):
+    def __init__(self, target_ext='.xml', workers=1, pin_index=None, resume=False,
+                 flush_bytes=None, fsync=EPinWriter.FSYNC_NEVER, recursive=False,
+                 epins_filename=None, report_filename=None, report_format=None,
+                 instrumentation=None, sms_filter=None, backend=BACKEND_ETREE,
+                 compressed=True, sink=None, serial_store=None):
+        if backend not in self.BACKENDS:
+            raise ValueError("Invalid parse backend: %s" % backend)
+        self._backend = backend
         self._target_ext = (target_ext or '.xml')
+        self._compressed = compressed
+        self._sink_factory = sink
+        self._serial_store = serial_store
+        self._sms_filter = sms_filter
+        self._instrumentation = instrumentation
+        self._timed = instrumentation is not None
+        if epins_filename:
+            self.EPINS_FILENAME = epins_filename
+        if report_filename:
+            self.REPORT_FILENAME = report_filename
+        if report_format is not None and report_format not in REPORT_WRITERS:
+            raise ValueError("Invalid report format: %s" % report_format)
+        self._report_format = report_format
+        self._recursive = recursive
+        self._workers = (workers or 1)
+        self._pin_index = pin_index
+        self._resume = resume
+        self._flush_bytes = (flush_bytes or self.FLUSH_BYTES)
+        self._fsync = fsync
+        self._journal = None
+        self._sink = None
+        self._mover = None
+        self._cancel = None
+        self._progress = None
+        self.__line_format = None
         self.__sngen = None
     
     @property
     def sngen(self):
         if not self.__sngen:
-            self.__sngen = SNGen()
+            if self._serial_store is not None:
+                self.__sngen = LeasedSNGen(self._serial_store)
+            else:
+                self.__sngen = SNGen()
         return self.__sngen
     
     @sngen.setter
     def sngen(self, value):
+        self.__line_format = None
         self.__sngen = value
+    
+    def __getstate__(self):
+        # only what is needed to parse files is shipped to worker processes
+        state = self.__dict__.copy()
+        state['_pin_index'] = None
+        state['_journal'] = None
+        state['_sink'] = None
+        state['_sink_factory'] = None
+        state['_mover'] = None
+        state['_cancel'] = None
+        state['_progress'] = None
+        state['_instrumentation'] = None
+        state['_serial_store'] = None
+        state['_EPXEngine__sngen'] = None
+        return state
+    
+    @property
+    def line_format(self):
+        """Returns EPIN_LINE_FORMAT compiled into a positional format string
+        with the constant date field already rendered in.
+        """
+        if not self.__line_format:
+            today = self.sngen.timestamp.strftime('%d/%m/%Y')
+            self.__line_format = self.EPIN_LINE_FORMAT\
+                .replace('{today}', today.replace('{', '{{').replace('}', '}}'))\
+                .replace('{number}', '{0}')\
+                .replace('{serial}', '{1}')\
+                .replace('{value}', '{2}')
+        return self.__line_format
 
     def parse(self, smsfile):
         if isinstance(smsfile, str):
             if not os.path.exists(smsfile):
                 raise FileNotFoundError(smsfile)
         
-        root = ET.parse(smsfile).getroot()
-        for node in root.findall('./sms'):
-            yield Packt.parse(node.attrib['body'])
+        accepts = (self._sms_filter.accepts if self._sms_filter else None)
+        for address, type, body in self._iter_backup(smsfile):
+            if accepts is None or accepts(address, type, body):
+                yield Packt.parse(body)
+    
+    def _iter_backup(self, smsfile):
+        # compressed files and archives are read as streams and never get
+        # extracted; they are parsed incrementally whatever the backend
+        name = (smsfile if isinstance(smsfile, str) else getattr(smsfile, 'name', ''))
+        ext = os.path.splitext(str(name))[1].lower()
+        if (ext in DirScanner.ARCHIVE_EXTS or ext in DirScanner.COMPRESSED_EXTS):
+            return self._iter_stream(smsfile, ext)
+        return self._iter_sms(smsfile)
+    
+    def _iter_stream(self, smsfile, ext):
+        opened = isinstance(smsfile, str)
+        f = (open(smsfile, 'rb') if opened else smsfile)
+        try:
+            if ext in DirScanner.ARCHIVE_EXTS:
+                yield from self._iter_archive(f)
+            else:
+                with self._decompress(f, ext) as stream:
+                    yield from self._iterparse_sms(stream)
+        finally:
+            if opened:
+                f.close()
+    
+    def _iter_archive(self, f):
+        # zip members holding target files are read one after the other
+        import zipfile
+        
+        found = False
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                base, ext = os.path.splitext(info.filename)
+                ext = ext.lower()
+                if ext not in DirScanner.COMPRESSED_EXTS:
+                    base, ext = (info.filename, None)
+                if info.is_dir() or not base.endswith(self._target_ext):
+                    continue
+                
+                found = True
+                with archive.open(info) as member:
+                    with self._decompress(member, ext) as stream:
+                        yield from self._iterparse_sms(stream)
+        if not found:
+            raise ValueError("Archive holds no target files.")
+    
+    @staticmethod
+    def _decompress(f, ext):
+        if ext == '.gz':
+            import gzip
+            return gzip.GzipFile(fileobj=f, mode='rb')
+        if ext == '.bz2':
+            import bz2
+            return bz2.BZ2File(f)
+        if ext == '.xz':
+            import lzma
+            return lzma.LZMAFile(f)
+        return f
+    
+    def _iter_sms(self, smsfile):
+        # yields (address, type, body) of each sms with the selected backend
+        if self._backend == self.BACKEND_MMAP:
+            return SmsScanner(smsfile)
+        return self._iterparse_sms(smsfile)
     
-    def process(self, dirpath, indicator=None):
+    def _iterparse_sms(self, smsfile):
+        # parse incrementally; every node under the root, <sms> or otherwise
+        # such as <mms> with its parts, is released once it ends so memory
+        # use stays flat regardless of the size of the backup file
+        root, depth = None, 0
+        for event, node in ET.iterparse(smsfile, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = node
+                depth += 1
+                continue
+            
+            depth -= 1
+            if depth != 1:
+                continue
+            sms = None
+            if node.tag == 'sms':
+                attrib = node.attrib
+                sms = (attrib.get('address'), attrib.get('type'), attrib['body'])
+            node.clear()
+            root.clear()
+            if sms is not None:
+                yield sms
+    
+    def process(self, dirpath, indicator=None, cancel=None):
         if not os.path.exists(dirpath):
             raise ValueError("Provided directory path doesn't exist.")
+        if not os.path.isdir(dirpath):
+            raise ValueError("Invalid directory path provided.")
         
-        # remove target files
-        for name in [self.EPINS_FILENAME, self.REPORT_FILENAME]:
-            try:
-                fullpath = os.path.join(dirpath, name)
-                if os.path.exists(fullpath):
-                    os.remove(fullpath)
-            except:
-                pass
-            
-        result = _(dirpath=dirpath, errors=[], failed=[], passed=[], lines=[], pos=0)
-        pInd = (indicator or HallowIndicator())
+        result = self._new_result(dirpath)
+        self._cancel = cancel
+        self._sink = self._open_sink(dirpath)
+        records = self._open_journal(result)
+        progress = self._progress = Progress(indicator, self.PROGRESS_INTERVAL)
+        inst = self._instrumentation
+        if inst is not None:
+            inst.start()
         try:
-            filenames = self._listdir(dirpath)
-            pInd.init(task_count=len(filenames), level=0)
+            skipped = self._restore_result(records, result)
+            scanner = self._listdir(dirpath, exclude=skipped)
+            task_count = scanner.count
+            progress.init(task_count)
         except Exception as ex:
             result.errors.append(_(filename=None, smsno=None, error=str(ex)))
         else:
-            first_flush = True
-            for f in filenames:
-                passed = self._process_file(f, result)
-                pInd.update(done=False, task_passed=passed)
-                if len(result.lines) >= 1000:
-                    self._flush_result(result, first_flush)
-                    first_flush=False
-            self._flush_result(result, first_flush)
-            pInd.update(done=True)
+            # output of a cancelled run is kept but its journal is left open
+            # so the run can later be resumed
+            try:
+                for f, parsed in self._parse_files(dirpath, scanner):
+                    if task_count != scanner.count:
+                        task_count = scanner.count
+                        progress.init(task_count)
+                    self._process_file(f, result, parsed)
+                    if result.size >= self._flush_bytes:
+                        self._flush_result(result)
+            except ProcessCancelled:
+                result.cancelled = True
+            result.errors.extend(_(filename=None, smsno=None, error=x)
+                                 for x in scanner.errors)
+            self._flush_result(result)
+            self._close_mover(result)
+            self._sink.close()
+            if not result.cancelled:
+                self._journal.finish()
+            progress.finish()
+        finally:
+            self._close_mover(result)
+            self._sink.close(commit=False)
+            self._journal.close()
+            self._sink = self._journal = self._cancel = self._progress = None
+            self._close_sngen()
+            if inst is not None:
+                inst.stop()
+                result.stages = inst.summary()
+                result.peak_memory = inst.peak_memory
+        return result
+    
+    def watch(self, dirpath, interval=1.0, settle=2.0, indicator=None, cancel=None,
+              on_batch=None):
+        """Watches a directory for backup files, processing each batch of files
+        which stopped growing as it is found by polls made every `interval`
+        seconds. Output is committed after each batch and a section for the
+        batch is appended to the text report; `on_batch` is called with the
+        result of each batch. Runs until cancelled and returns the totals.
+        """
+        if not os.path.isdir(dirpath):
+            raise ValueError("Provided directory path doesn't exist.")
+        
+        cancel = (cancel or CancelToken())
+        totals = _(dirpath=dirpath, batches=0, passed=0, failed=0, pins=0,
+                   duplicates=0, skipped=0)
+        result = self._new_result(dirpath)
+        self._cancel = cancel
+        self._sink = self._open_sink(dirpath, append=True)
+        records = self._open_journal(result, append=True)
+        report = None
+        try:
+            report = open(os.path.join(dirpath, self.REPORT_FILENAME), 'a',
+                          encoding='utf-8')
+            watcher = DirWatcher(dirpath, self._target_ext, self._recursive,
+                                 {'_passed'}, self._compressed, settle)
+            watcher.skip(self._restore_result(records, result))
+            checkpoint = self._flush_result(result)
+            self._close_mover(result)
+            self._sink.close()
+            self._sink = None
+            
+            while True:
+                ready = watcher.poll()
+                if ready:
+                    result = self._watch_batch(dirpath, ready, checkpoint, indicator)
+                    checkpoint = result.checkpoint
+                    TextReport().write_batch(result, report)
+                    report.flush()
+                    totals.batches += 1
+                    totals.passed += len(result.passed)
+                    totals.failed += len(result.failed)
+                    for key in ('pins', 'duplicates', 'skipped'):
+                        totals[key] += result[key]
+                    if on_batch is not None:
+                        on_batch(result)
+                if cancel.cancelled or cancel.wait(interval):
+                    break
+            self._journal.finish()
+        finally:
+            if report is not None:
+                report.close()
+            if self._sink is not None:
+                self._sink.close(commit=False)
+            self._journal.close()
+            self._sink = self._journal = self._cancel = self._progress = None
+            self._close_sngen()
+        return totals
+    
+    def _watch_batch(self, dirpath, filenames, checkpoint, indicator=None):
+        # the sink is reopened for each batch and closed once done with so
+        # output is committed and visible between batches
+        result = self._new_result(dirpath)
+        result.stamp = datetime.now()
+        self._renew_sngen(result.stamp)
+        self._sink = self._open_sink(dirpath, append=True)
+        self._sink.restore(checkpoint)
+        progress = self._progress = Progress(indicator, self.PROGRESS_INTERVAL)
+        progress.init(len(filenames))
+        try:
+            for f, parsed in self._parse_files(dirpath, filenames):
+                self._process_file(f, result, parsed)
+        except ProcessCancelled:
+            result.cancelled = True
+        result.checkpoint = self._flush_result(result)
+        self._close_mover(result)
+        self._sink.close()
+        self._sink = None
+        progress.finish()
         return result
     
     def write_report(self, result):
         fullpath = os.path.join(result.dirpath, self.REPORT_FILENAME)
-        with open(fullpath, 'w') as f:
-            f.write((
-                " ePinXtractr Extraction Report\n%(hr)s\n\n"
-                "Directory:  %(dirpath)s\n"
-                "File Count: %(file_count)s\n"
-                "Pass Count: %(pass_count)s\n"
-                "Fail Count: %(fail_count)s\n"
-                "\n%(hr)s\n\n"
-                "PASSED:\n*******\n"
-                "%(passed)s\n"
-                "\n%(hr)s\n\n"
-                "FAILED:\n*******\n"
-                "%(failed)s\n"
-                "\n%(hr)s\n\n"
-                "ERRORS:\n*******\n"
-                "%(errors)s\n"
-                "\n%(hr)s\n\n"
-            ) % {
-                'hr': ('=' * 70),
-                'dirpath': result.dirpath,
-                'file_count': len(result.passed) + len(result.failed),
-                'pass_count': len(result.passed),
-                'fail_count': len(result.failed),
-                'passed': (', '.join(result.passed) or '-'),
-                'failed': (', '.join(result.failed) or '-'),
-                'errors': ('\n\n'.join(result.errors) or '-')
-            })
+        report = REPORT_WRITERS[self._report_format or
+                                report_format(self.REPORT_FILENAME)]()
+        with open(fullpath, 'w', encoding='utf-8') as f:
+            report.write(result, f)
             f.flush()
     
     def _format_epin(self, epin):
-        line = self.EPIN_LINE_FORMAT\
-                   .replace('{number}', epin.number)\
-                   .replace('{serial}', self.sngen.get())\
-                   .replace('{value}', '{:0>7}00'.format(epin.value))\
-                   .replace('{today}', self.sngen.timestamp.strftime('%d/%m/%Y'))
-        return line
-    
-    def _flush_result(self, result, first_flush):
-        dirpath = result.dirpath
+        value = '{:0>7}00'.format(epin.value)
+        return self.line_format.format(epin.number, self.sngen.get(), value)
+    
+    def _format_packt(self, packt):
+        # pins are validated before serials for the packt are reserved
+        batch = packt
+        if not isinstance(batch, EPinBatch):
+            batch = EPinBatch.from_packt(packt)
+        
+        value = '{:0>7}00'.format(batch.value)
+        serials = self.sngen.reserve(batch.count)
+        fmt = self.line_format.format
+        return [fmt(pin, serial, value)
+                for pin, serial in zip(batch.pins(), serials)]
+    
+    def _flush_result(self, result):
+        dirpath, inst = (result.dirpath, self._instrumentation)
+        if inst is not None:
+            mark, nbytes = (inst.clock(), result.size)
         if result.lines:
-            fullpath = os.path.join(dirpath, self.EPINS_FILENAME)
-            with open(fullpath, 'w' if first_flush else 'a') as f:
-                f.write('\n'.join(result.lines))
-                f.flush()
-            result.lines = []
-        
-        for label in ["passed"]:
-            if result[label]:
-                dirdest = os.path.join(dirpath, "_%s" % label)
-                files_chunk = result[label][result.pos:]
-                self._move_files(files_chunk, dirdest, result)
-                result.pos += len(files_chunk)
-
-    def _process_file(self, filename, result):
+            write = self._sink.write
+            for value, lines in result.lines:
+                write(lines, value)
+            result.lines, result.size = ([], 0)
+        offset = self._sink.flush()
+        if inst is not None:
+            inst.record_since('write', mark, nbytes=nbytes)
+        
+        # the journal is committed ahead of the pin index so a crash between
+        # both never has pins recorded for files that will be re-processed
+        if self._journal is not None:
+            self._journal.commit(result.pending, offset)
+            result.pending = []
+        
+        if self._pin_index is not None:
+            self._pin_index.commit()
+        
+        if result.moves:
+            dirdest = os.path.join(dirpath, "_passed")
+            self._move_files(result.moves, dirdest, result)
+            result.moves = []
+        return offset
+
+    def _parse_file(self, fullpath):
+        # collects epin batches up to the first failing sms; the error is
+        # returned rather than raised so this can run within a worker process
+        batches, cancel, progress = ([], self._cancel, self._progress)
+        stride, error, size, skipped = (Progress.MESSAGE_STRIDE, None, 0, 0)
+        accepts = (self._sms_filter.accepts if self._sms_filter else None)
+        if self._timed:
+            timings, clock = (Instrumentation(), Instrumentation.clock)
+            started, packt_wall, packt_cpu = (clock(), 0.0, 0.0)
+        
+        try:
+            with open(fullpath, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                messages = self._iter_backup(f)
+                tell = getattr(messages, 'tell', f.tell)
+                for i, (address, type, body) in enumerate(messages):
+                    if cancel is not None:
+                        cancel.check()
+                    # the offset within the file is noted every few messages
+                    if progress is not None and not i % stride:
+                        progress.message(tell(), size)
+                    if accepts is not None and not accepts(address, type, body):
+                        skipped += 1
+                        continue
+                    if not self._timed:
+                        batches.append(EPinBatch.from_packt(Packt.parse(body)))
+                        continue
+                    
+                    mark = clock()
+                    batches.append(EPinBatch.from_packt(Packt.parse(body)))
+                    now = clock()
+                    packt_wall += now[0] - mark[0]
+                    packt_cpu += now[1] - mark[1]
+        except ProcessCancelled:
+            raise
+        except Exception as ex:
+            error = str(ex)
+        
+        if not self._timed:
+            return (batches, error, skipped, None)
+        
+        # time spent in the xml parser is what remains outside packt parsing
+        now = clock()
+        timings.record('xml', now[0] - started[0] - packt_wall,
+                       now[1] - started[1] - packt_cpu, nbytes=size)
+        timings.record('packt', packt_wall, packt_cpu, calls=len(batches))
+        return (batches, error, skipped, timings.stages)
+    
+    def _parse_files(self, dirpath, filenames):
+        cancel = self._cancel
+        if self._workers <= 1:
+            for f in filenames:
+                if cancel is not None:
+                    cancel.check()
+                yield f, self._parse_file(os.path.join(dirpath, f))
+            return
+        
+        # files are parsed in parallel but results are consumed in order so
+        # serials and output lines match those of a serial run; submissions
+        # are kept to a window as filenames stream in from the scan
+        from concurrent.futures import ProcessPoolExecutor, TimeoutError as WaitTimeout
+        window, limit = (deque(), self._workers * 4)
+        executor = ProcessPoolExecutor(max_workers=self._workers)
+        
+        def next_result():
+            # workers cannot see the token so it is checked while waiting on
+            # them; a future is only dropped from the window once done with
+            f, future = window[0]
+            while cancel is not None:
+                cancel.check()
+                try:
+                    future.result(timeout=self.CANCEL_INTERVAL)
+                    break
+                except WaitTimeout:
+                    pass
+            window.popleft()
+            return f, future.result()
+        
+        try:
+            for f in filenames:
+                if cancel is not None:
+                    cancel.check()
+                fullpath = os.path.join(dirpath, f)
+                window.append((f, executor.submit(self._parse_file, fullpath)))
+                if len(window) >= limit:
+                    yield next_result()
+            while window:
+                yield next_result()
+        finally:
+            # on cancellation queued files are dropped and the workers still
+            # parsing are terminated rather than left running past the run
+            if not window:
+                executor.shutdown()
+            else:
+                processes = list((executor._processes or {}).values())
+                executor.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                for process in processes:
+                    process.join()
+
+    def _process_file(self, filename, result, parsed=None):
         dirpath, passed = (result.dirpath, False)
+        if parsed is None:
+            parsed = self._parse_file(os.path.join(dirpath, filename))
+        
+        index, cancel, inst = (self._pin_index, self._cancel, self._instrumentation)
+        if index is not None:
+            index.savepoint()
+        
         try:
-            lines, smsno = ([], 1)
-            for packt in self.parse(os.path.join(dirpath, filename)):
-                for epin in packt:
-                    lines.append(self._format_epin(epin))
+            chunks, duplicates = ([], 0)
+            batches, error, skipped, stages = parsed
+            # skipped sms are counted so a failing sms is numbered as in the file
+            smsno = skipped + 1
+            if inst is not None:
+                inst.merge(stages)
+            for batch in batches:
+                if cancel is not None:
+                    cancel.check()
+                if index is not None:
+                    if inst is not None:
+                        mark = inst.clock()
+                    batch, dropped = index.filter(batch)
+                    duplicates += dropped
+                    if inst is not None:
+                        inst.record_since('dedupe', mark)
+                
+                if inst is None:
+                    chunks.append((batch.value, self._format_packt(batch)))
+                else:
+                    mark = inst.clock()
+                    chunks.append((batch.value, self._format_packt(batch)))
+                    inst.record_since('format', mark)
                 smsno += 1
             
+            if error is not None:
+                raise ValueError(error)
+            
+            if index is not None:
+                index.release()
             result.passed.append(filename)
-            result.lines.extend(lines)
-            passed = True
+            result.moves.append(filename)
+            # lines are kept in chunks sharing an epin value for the sink
+            pins = sum(len(lines) for value, lines in chunks)
+            result.lines.extend(x for x in chunks if x[1])
+            result.size += sum(len(x) for value, lines in chunks for x in lines) + pins
+            result.pins += pins
+            result.duplicates += duplicates
+            result.skipped += skipped
+            passed, error = (True, None)
+        except ProcessCancelled:
+            if index is not None:
+                index.rollback()
+            raise
         except Exception as ex:
+            if index is not None:
+                index.rollback()
             result.errors.append(_(filename=filename, smsno=smsno, error=str(ex)))
             result.failed.append(filename)
-            passed = False
+            passed, error, duplicates, pins = (False, str(ex), 0, 0)
+        
+        # a file gone since it was parsed is journaled without size and time
+        # so it never matches a file later put in its place
+        try:
+            st = os.stat(os.path.join(dirpath, filename))
+            size, mtime = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            size, mtime = (0, 0)
+        if self._progress is not None:
+            self._progress.file_done(passed, pins, smsno - 1, size)
+        if self._journal is not None:
+            result.pending.append({
+                'name': filename, 'size': size, 'mtime': mtime,
+                'passed': passed, 'smsno': smsno, 'error': error,
+                'duplicates': duplicates, 'skipped': skipped})
         return passed
     
-    def _listdir(self, dirpath):
-        if not dirpath or not os.path.isdir(dirpath):
-            raise ValueError('Invalid directory path provided.')
-        
-        filenames = []
-        for f in os.listdir(dirpath):
-            if self._target_ext:
-                if not f.endswith(self._target_ext):
-                    continue
-            filenames.append(f)
-        return filenames
+    def _new_result(self, dirpath):
+        window = self.RESULT_WINDOW
+        return _(dirpath=dirpath, errors=SpillList(window=window),
+                 failed=SpillList(window=window), passed=SpillList(window=window),
+                 lines=[], size=0, moves=[], pins=0, duplicates=0, skipped=0,
+                 pending=[], cancelled=False)
     
-    def _move_files(self, files, dirdest, result):
+    def _renew_sngen(self, now):
+        # a long running watch outlives the day its serial prefix and the date
+        # within output lines were taken on; both are renewed once it changes
+        sngen = self.__sngen
+        if sngen is not None and sngen.timestamp.date() != now.date():
+            sngen.close()
+            self.__sngen = self.__line_format = None
+    
+    def _close_sngen(self):
+        # leased serials not handed out are given back once a run is over
+        if self.__sngen is not None:
+            self.__sngen.close()
+    
+    def _open_sink(self, dirpath, append=False):
+        # sink factories are called with the full path of the output
+        path = os.path.join(dirpath, self.EPINS_FILENAME)
+        if self._sink_factory is not None:
+            if append:
+                return self._sink_factory(path, append=True)
+            return self._sink_factory(path)
+        return EPinWriter(path, buffer_size=self._flush_bytes, fsync=self._fsync,
+                          append=append)
+    
+    def _open_journal(self, result, append=False):
+        # when resuming, and always when appending as in watch mode, output
+        # is kept and the journal carried on from its last checkpoint whether
+        # the run it belongs to completed or not; else output from an earlier
+        # run is removed and a new journal started
+        from epx.store import Journal
+        
         dirpath = result.dirpath
-        if not os.path.exists(dirdest):
+        journal = Journal(os.path.join(dirpath, self.JOURNAL_FILENAME))
+        resume = (self._resume or append)
+        records, offset, done = (journal.load() if resume else ({}, None, True))
+        if resume:
+            if offset is not None:
+                self._sink.restore(offset)
+        else:
+            self._sink.discard()
             try:
-                os.mkdir(dirdest)
-            except Exception as ex:
-                err_msg = "Unabled to create directory. (Error: %s)"
-                result.errors.append(err_msg % str(ex))
+                fullpath = os.path.join(dirpath, self.REPORT_FILENAME)
+                if os.path.exists(fullpath):
+                    os.remove(fullpath)
+            except:
+                pass
         
-        if files and os.path.exists(dirdest):
-            for f in files:
-                try:
-                    shutil.move(os.path.join(dirpath, f), dirdest)
-                except Exception as ex:
-                    err_msg = "Unable to move file. (Error: %s)"
-                    result.errors.append(err_msg % str(ex))
-    
\ No newline at end of file
+        journal.open(resume=resume)
+        self._journal = journal
+        return records
+    
+    def _restore_result(self, records, result):
+        # restores the outcome of files committed by an earlier run and
+        # returns the names of those which need no further processing
+        dirpath = result.dirpath
+        moved, unmoved, skipped = ([], [], set())
+        for name, record in records.items():
+            fullpath = os.path.join(dirpath, name)
+            if record['passed']:
+                (unmoved if os.path.exists(fullpath) else moved).append(name)
+                result.duplicates += record['duplicates']
+                result.skipped += record.get('skipped', 0)
+                skipped.add(name)
+            elif os.path.exists(fullpath):
+                st = os.stat(fullpath)
+                if (st.st_size, st.st_mtime_ns) == (record['size'], record['mtime']):
+                    result.errors.append(_(filename=name, smsno=record['smsno'],
+                                           error=record['error']))
+                    result.failed.append(name)
+                    skipped.add(name)
+        
+        # journaled files still present get moved along with the next flush
+        result.passed.extend(moved + unmoved)
+        result.moves.extend(unmoved)
+        return skipped
+    
+    def _listdir(self, dirpath, exclude=()):
+        # output directories of earlier runs are never scanned
+        exclude = set(exclude) | {'_passed'}
+        return DirScanner(dirpath, self._target_ext, self._recursive, exclude,
+                          compressed=self._compressed)
+    
+    def _move_files(self, files, dirdest, result):
+        # files are relocated in the background; errors of completed moves
+        # are picked up here and the rest once the mover is closed
+        inst = self._instrumentation
+        if inst is not None:
+            mark = inst.clock()
+        if self._mover is None or self._mover.dirdest != dirdest:
+            self._close_mover(result)
+            self._mover = FileMover(result.dirpath, dirdest)
+        
+        self._mover.submit(files)
+        result.errors.extend(self._mover.collect())
+        if inst is not None:
+            inst.record_since('move', mark, calls=len(files))
+    
+    def _close_mover(self, result):
+        if self._mover is not None:
+            inst = self._instrumentation
+            if inst is not None:
+                mark = inst.clock()
+            result.errors.extend(self._mover.close())
+            self._mover = None
+            if inst is not None:
+                inst.record_since('move', mark, calls=0)
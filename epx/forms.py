@@ -3,13 +3,16 @@ Defines the forms that represents the GUI for ePinXtractr.
 """
 import os
 import epx
+import queue
+import threading
 from tkinter import *
 from tkinter.ttk import *
 from tkinter import messagebox
 from tkinter.filedialog import Directory
 
 from fysom import Fysom
-from epx.core import EPXEngine, HallowIndicator
+from dolfin import Storage as _
+from epx.core import EPXEngine, HallowIndicator, DirScanner, CancelToken, Progress
 
 
 TARGET_EXT = '.xml'
@@ -19,22 +22,22 @@ ICON_PATH = './epx.ico'
 class ePinXtractr(object):
     TITLE = epx.__name__
 
+    POLL_INTERVAL = 100
+
     class Indicator(HallowIndicator):
-        def __init__(self, pbar):
-            pbar.config(mode='determinate', value=0)
-            self._maximum = None
-            self._value = 1
-            self.pbar = pbar
+        """Posts progress from the engine thread onto a queue which the Tk
+        main thread polls to update the progress bar.
+        """
+        def __init__(self, events):
+            self.events = events
 
         def init(self, task_count=0, level=0):
-            self.pbar.config(maximum=task_count)
-            self._maximum = task_count
+            if level == Progress.LEVEL_DIRECTORY:
+                self.events.put(('init', task_count))
         
-        def update(self, done=False, task_passed=None):
-            value = self._value + 1 if not done else self._maximum
-            self.pbar.config(value=value)
-            self.pbar.update()
-            self._value = value
+        def update(self, done=False, task_passed=None, level=0, stats=None):
+            # stats keep changing on the engine thread so a copy is posted
+            self.events.put(('update', (done, level, stats.copy())))
 
     def __init__(self, root=None):
         super(ePinXtractr, self).__init__()
@@ -140,21 +143,16 @@ class ePinXtractr(object):
         
         # get directory content details
         detail_fmt = "sub-dirs: %s / files: %s / sms-files: %s"
-        dirpath, dirnames, filenames = next(os.walk(dirpath))
-        xmlfiles = [f for f in filenames if f.endswith(TARGET_EXT)]
-
+        stats = DirScanner(dirpath, TARGET_EXT, compressed=True).summary()
         self.var_dirstats.set(detail_fmt % (
-            len(dirnames), len(filenames), len(xmlfiles)))
+            stats.dirs, stats.files, stats.targets))
 
         if not self.processbox.grid_info():
             self._toggle_processbox(True)
         
         # set process button state
-        self.btn_process.config(state=DISABLED if len(xmlfiles) == 0 else NORMAL)
+        self.btn_process.config(state=DISABLED if stats.targets == 0 else NORMAL)
 
-    def _cancel(self):
-        pass
-    
     def _manage_state(self):
         if self._fsm.isstate('start'):
             self._fsm.process()
@@ -186,26 +184,75 @@ class ePinXtractr(object):
     
     def _on_process(self, e):
         self.btn_browse.config(state=DISABLED)
+        self.pbar.config(mode='determinate', value=0)
         self.pbar.grid(row=0, column=0, ipady=1, padx=(0, 3), sticky='WE')
-        self.pbar.update()
 
         self.btn_process.config(text='Cancel', state=NORMAL)
         self.var_opsstats.set('processing...')
         
-        engine = EPXEngine(TARGET_EXT)
-        result = engine.process(self.var_dirpath.get(),
-                    self.Indicator(self.pbar))
-        
-        engine.write_report(result)
-        self.var_opsstats.set('done')
-        self._fsm.done(result=result)
+        # the engine runs on a worker thread and reports back via the queue
+        self._events = queue.Queue()
+        self._token = CancelToken()
+        self._maximum = 0
+        worker = threading.Thread(target=self._run_engine, daemon=True,
+            args=(self.var_dirpath.get(), self._events, self._token))
+        worker.start()
+        self.root.after(self.POLL_INTERVAL, self._poll_events)
+    
+    def _run_engine(self, dirpath, events, token):
+        try:
+            engine = EPXEngine(TARGET_EXT)
+            result = engine.process(dirpath, self.Indicator(events), token)
+            engine.write_report(result)
+            events.put(('result', result))
+        except Exception as ex:
+            events.put(('error', ex))
+    
+    def _poll_events(self):
+        while True:
+            try:
+                event, value = self._events.get_nowait()
+            except queue.Empty:
+                break
+            
+            if event == 'init':
+                self._maximum = value
+                self.pbar.config(maximum=value)
+            elif event == 'update':
+                done, level, stats = value
+                self.pbar.config(value=self._maximum if done else stats['files'])
+                text = Progress.describe(_(stats))
+                if level == Progress.LEVEL_FILE and stats['file_size']:
+                    text += " | file %d%%" % (
+                        100 * stats['file_offset'] // stats['file_size'])
+                self.var_opsstats.set(text)
+            elif event == 'result':
+                self._on_finished(value)
+                return
+            elif event == 'error':
+                self._on_finished(None)
+                messagebox.showerror(self.TITLE, str(value))
+                return
+        self.root.after(self.POLL_INTERVAL, self._poll_events)
+    
+    def _on_finished(self, result):
+        if self._fsm.isstate('processing'):
+            self.var_opsstats.set('done')
+            self._fsm.done(result=result)
+        else:
+            self._config_widget_for_result()
+            self.var_opsstats.set('aborted!')
     
     def _on_cancel(self, e):
-        self._config_widget_for_result()
-        self.var_opsstats.set('aborted!')
+        self._token.cancel()
+        self.btn_process.config(state=DISABLED)
+        self.var_opsstats.set('cancelling...')
     
     def _on_done(self, e):
         self._config_widget_for_result()
+        if e.result is None:
+            self.var_opsstats.set('failed!')
+            return
         self.var_opsstats.set(
             "[ p:%s / f:%s ]" % (len(e.result.passed), len(e.result.failed)))
 
@@ -0,0 +1,187 @@
+"""
+Defines the report writers for ePinXtractr.
+
+Writers stream each section of a report straight into the open file so
+the lists of a result, which may be spilled onto disk, are never joined
+or otherwise held in memory. Jinja2 and pathlib are only imported when an
+html report gets written.
+"""
+import os
+import threading
+
+import epx
+
+
+
+DOCS_DIR = os.path.abspath(os.path.join(epx.BASE_DIR, '..', 'docs'))
+HR = '=' * 70
+
+
+class TextReport(object):
+    """Represents the plain text report of a run."""
+
+    def write(self, result, f):
+        passed, failed = (len(result.passed), len(result.failed))
+        f.write(
+            " ePinXtractr Extraction Report\n%(hr)s\n\n"
+            "Directory:  %(dirpath)s\n"
+            "File Count: %(file_count)s\n"
+            "Pass Count: %(pass_count)s\n"
+            "Fail Count: %(fail_count)s\n"
+            "Dupe Count: %(dupe_count)s\n"
+            "Skip Count: %(skip_count)s\n"
+            "\n%(hr)s\n\n" % {
+                'hr': HR,
+                'dirpath': result.dirpath,
+                'file_count': passed + failed,
+                'pass_count': passed,
+                'fail_count': failed,
+                'dupe_count': result.get('duplicates', 0),
+                'skip_count': result.get('skipped', 0)
+            })
+        self._write_section(f, 'PASSED', result.passed, ', ')
+        self._write_section(f, 'FAILED', result.failed, ', ')
+        self._write_section(f, 'ERRORS', map(self.format_error, result.errors), '\n\n')
+        if result.get('stages') is not None:
+            self._write_timings(f, result)
+
+    def write_batch(self, result, f):
+        """Writes a section for a batch of files processed in watch mode."""
+        f.write(
+            "BATCH %(stamp)s\n"
+            "Pass Count: %(pass_count)s / Fail Count: %(fail_count)s / "
+            "Pin Count: %(pins)s / Dupe Count: %(dupe_count)s / "
+            "Skip Count: %(skip_count)s\n" % {
+                'stamp': result.stamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'pass_count': len(result.passed),
+                'fail_count': len(result.failed),
+                'pins': result.pins,
+                'dupe_count': result.duplicates,
+                'skip_count': result.skipped
+            })
+        if len(result.passed):
+            self._write_items(f, "Passed: ", result.passed, ', ')
+        if len(result.failed):
+            self._write_items(f, "Failed: ", result.failed, ', ')
+        if len(result.errors):
+            self._write_items(f, "", map(self.format_error, result.errors), '\n')
+        f.write("%s\n\n" % ('-' * 70))
+
+    def write_summary(self, summary, f):
+        """Writes the combined summary of a run over many directories."""
+        f.write(
+            " ePinXtractr Batch Summary\n%(hr)s\n\n"
+            "Directory Count: %(dir_count)s\n"
+            "Pass Count:      %(passed)s\n"
+            "Fail Count:      %(failed)s\n"
+            "Pin Count:       %(pins)s\n"
+            "Dupe Count:      %(duplicates)s\n"
+            "Skip Count:      %(skipped)s\n"
+            "Elapsed:         %(elapsed).1fs\n"
+            "\n%(hr)s\n\n" % dict(summary, hr=HR, dir_count=len(summary.dirs)))
+        f.write("%-8s %8s %8s %10s %9s  %s\n" % (
+            'status', 'passed', 'failed', 'pins', 'time(s)', 'directory'))
+        for x in summary.dirs:
+            status = ('error' if x.error else 'cancel' if x.cancelled else
+                      'failed' if x.failed else 'ok')
+            f.write("%-8s %8d %8d %10d %9.1f  %s\n" % (
+                status, x.passed, x.failed, x.pins, x.elapsed, x.dirpath))
+            if x.error:
+                f.write("%-8s %s\n" % ('', x.error))
+        f.write("\n%s\n\n" % HR)
+
+    @staticmethod
+    def format_error(error):
+        lines = ["File:  %s" % (error.filename or '-')]
+        if error.smsno is not None:
+            lines.append("SMS #: %s" % error.smsno)
+        lines.append("Error: %s" % error.error)
+        return '\n'.join(lines)
+
+    def _write_section(self, f, title, items, sep):
+        f.write("%s:\n%s\n" % (title, '*' * (len(title) + 1)))
+        if not self._write_items(f, '', items, sep):
+            f.write('-\n')
+        f.write("\n%s\n\n" % HR)
+
+    def _write_items(self, f, prefix, items, sep):
+        count = 0
+        f.write(prefix)
+        for item in items:
+            f.write(sep + item if count else item)
+            count += 1
+        if count:
+            f.write('\n')
+        return count
+
+    def _write_timings(self, f, result):
+        f.write("TIMINGS:\n********\n")
+        f.write("%-8s %10s %10s %10s %14s\n" % (
+            'stage', 'calls', 'wall(s)', 'cpu(s)', 'bytes'))
+        for x in result.stages:
+            f.write("%-8s %10d %10.3f %10.3f %14d\n" % (
+                x.stage, x.calls, x.wall, x.cpu, x.bytes))
+        if result.get('peak_memory') is not None:
+            f.write("\nPeak Traced Memory: %s bytes\n" % result.peak_memory)
+        f.write("\n%s\n\n" % HR)
+
+
+class HtmlReport(object):
+    """Represents the html report of a run rendered from the report template
+    within the docs directory. The compiled template is cached on the class
+    so it is loaded once per process however many runs get reported.
+    """
+
+    TEMPLATE_NAME = 'report.tpl'
+    _template = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_template(cls):
+        if cls._template is None:
+            with cls._lock:
+                if cls._template is None:
+                    from jinja2 import Environment, FileSystemLoader
+                    env = Environment(
+                        loader=FileSystemLoader(DOCS_DIR), autoescape=True,
+                        auto_reload=False)
+                    cls._template = env.get_template(cls.TEMPLATE_NAME)
+        return cls._template
+
+    def write(self, result, f):
+        import pathlib
+        
+        logo_path = os.path.join(epx.ASSET_DIR, 'imgs', 'logo-md.png')
+        passed, failed = (len(result.passed), len(result.failed))
+        context = {
+            'title': 'Report',
+            'app': {
+                'name': epx.__name__,
+                'version': epx.__version__,
+                'logo_path': pathlib.Path(logo_path).as_uri(),
+            },
+            'result': result,
+            'file_count': passed + failed,
+            'pass_count': passed,
+            'fail_count': failed,
+            'dupe_count': result.get('duplicates', 0),
+            'skip_count': result.get('skipped', 0),
+            'stages': result.get('stages'),
+            'peak_memory': result.get('peak_memory'),
+        }
+        for chunk in self.get_template().generate(context):
+            f.write(chunk)
+
+
+REPORT_TEXT = 'text'
+REPORT_HTML = 'html'
+REPORT_WRITERS = {
+    REPORT_TEXT: TextReport,
+    REPORT_HTML: HtmlReport,
+}
+
+
+def report_format(filename):
+    """Returns the report format implied by the extension of filename."""
+    ext = os.path.splitext(filename)[1].lower()
+    return REPORT_HTML if ext in ('.html', '.htm') else REPORT_TEXT
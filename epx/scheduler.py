@@ -0,0 +1,92 @@
+"""
+Defines the scheduler running ePinXtractr over many directories at once.
+
+Each directory is processed by an engine of its own on a thread of a
+bounded pool so a slow directory never holds up the others; engines with
+`workers` set still parse files in processes of their own. Every
+directory gets its own output and report and the outcome of all of them
+is gathered into a combined summary.
+"""
+import time
+import traceback
+
+from dolfin import Storage as _
+
+from epx.core import EPXEngine, CancelToken
+
+
+
+class Scheduler(object):
+    """Represents a run over many directories with at most `concurrency` of
+    them processed at a time. Engines are created per directory by calling
+    `engine_factory` which defaults to the engine class itself.
+    """
+
+    def __init__(self, engine_factory=None, concurrency=2):
+        if concurrency < 1:
+            raise ValueError("Invalid concurrency: %s" % concurrency)
+        self.engine_factory = (engine_factory or EPXEngine)
+        self.concurrency = concurrency
+
+    def run(self, dirpaths, cancel=None, on_done=None):
+        """Processes the directories and returns the combined summary. The
+        `on_done` callback is called with the summary of each directory as
+        it completes, in whichever order that happens.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        cancel = (cancel or CancelToken())
+        started = time.perf_counter()
+        dirpaths = list(dirpaths)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                futures = dict((executor.submit(self._run_one, x, cancel), i)
+                               for i, x in enumerate(dirpaths))
+                summaries = [None] * len(dirpaths)
+                for future in as_completed(futures):
+                    summary = summaries[futures[future]] = future.result()
+                    if on_done is not None:
+                        on_done(summary)
+            except BaseException:
+                # an interrupt stops the directories being processed and drops
+                # those not started rather than wait for all of them
+                cancel.cancel()
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        combined = _(dirs=summaries, elapsed=time.perf_counter() - started,
+                     cancelled=cancel.cancelled)
+        for key in ('passed', 'failed', 'pins', 'duplicates', 'skipped'):
+            combined[key] = sum(x[key] for x in summaries)
+        combined.errors = sum(1 for x in summaries if x.error)
+        return combined
+
+    def _run_one(self, dirpath, cancel):
+        # failures are kept within the summary of the directory so the rest
+        # of the directories carry on
+        summary = _(dirpath=dirpath, passed=0, failed=0, pins=0, duplicates=0,
+                    skipped=0, cancelled=False, elapsed=0.0, error=None)
+        started = time.perf_counter()
+        if cancel.cancelled:
+            summary.cancelled = True
+            return summary
+
+        result = None
+        try:
+            engine = self.engine_factory()
+            result = engine.process(dirpath, cancel=cancel)
+            engine.write_report(result)
+        except ValueError as ex:
+            summary.error = str(ex)
+        except Exception as ex:
+            summary.error = ''.join(traceback.format_exception_only(type(ex), ex)).strip()
+
+        if result is not None:
+            summary.update(
+                passed=len(result.passed), failed=len(result.failed),
+                pins=result.pins, duplicates=result.duplicates,
+                skipped=result.skipped, cancelled=result.cancelled)
+            for name in ('passed', 'failed', 'errors'):
+                result[name].close()
+        summary.elapsed = time.perf_counter() - started
+        return summary
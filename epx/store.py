@@ -0,0 +1,299 @@
+"""
+Defines the persistent stores used by ePinXtractr.
+"""
+import os
+import json
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+
+from epx.core import EPinBatch
+
+
+
+class PinIndex(object):
+    """Represents an on-disk index of the ePin numbers already emitted. It is
+    backed by an sqlite table keyed on the pin number so lookups stay within
+    O(log n) without holding the numbers in memory.
+
+    Checks for a file are made within a savepoint which is released or rolled
+    back depending on whether the file passes; `commit` makes the changes
+    durable and is expected to be called as output gets flushed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # the engine using the index may run on a thread other than this one
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pins (number INTEGER PRIMARY KEY)')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM pins').fetchone()[0]
+
+    def __contains__(self, number):
+        row = self._conn.execute(
+            'SELECT 1 FROM pins WHERE number = ?', (int(number),)).fetchone()
+        return row is not None
+
+    def filter(self, batch):
+        """Records the pin numbers in batch and returns a tuple of a batch with
+        only the numbers not seen before along with the count dropped.
+        """
+        execute, numbers = (self._conn.execute, [])
+        for number in batch.numbers:
+            cursor = execute('INSERT OR IGNORE INTO pins VALUES (?)', (number,))
+            if cursor.rowcount == 1:
+                numbers.append(number)
+
+        dropped = batch.count - len(numbers)
+        if dropped:
+            batch = EPinBatch(array('Q', numbers), batch.value)
+        return (batch, dropped)
+
+    def savepoint(self):
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+        self._conn.execute('SAVEPOINT pinfile')
+
+    def release(self):
+        self._conn.execute('RELEASE pinfile')
+
+    def rollback(self):
+        self._conn.execute('ROLLBACK TO pinfile')
+        self._conn.execute('RELEASE pinfile')
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+class Journal(object):
+    """Represents the processing journal kept within a target directory. File
+    records are appended as json lines and only count once a checkpoint line
+    carrying the committed size of the output file follows them; records after
+    the last checkpoint are discarded when the journal is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def load(self):
+        """Returns a tuple of the committed file records keyed by filename, the
+        committed output offset, or None without a checkpoint, and a flag
+        indicating if the run completed.
+        """
+        records, offset, done = ({}, None, False)
+        if not os.path.exists(self.path):
+            return (records, offset, done)
+
+        pending = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if 'checkpoint' in entry:
+                    records.update((r['name'], r) for r in pending)
+                    # a journal carried on after completing is open again
+                    offset, pending, done = (entry['checkpoint'], [], False)
+                elif 'done' in entry:
+                    done = True
+                elif 'name' in entry:
+                    pending.append(entry)
+        return (records, offset, done)
+
+    def open(self, resume=False):
+        self._file = open(self.path, 'a' if resume else 'w')
+
+    def commit(self, records, offset):
+        lines = [json.dumps(r) for r in records]
+        lines.append(json.dumps({'checkpoint': offset}))
+        self._write(lines)
+
+    def finish(self):
+        self._write([json.dumps({'done': True})])
+        self.close()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, lines):
+        self._file.write('\n'.join(lines) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+class SqliteSink(object):
+    """Represents an output sink loading epin lines into an sqlite table
+    along with their value. Lines are buffered between flushes and inserted
+    with batched executemany calls within a single transaction per flush; the
+    checkpoint of a flush is the id of the last row committed.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, path, table='epins', append=False):
+        # rows are always added in place so `append` changes nothing here
+        self.path = path
+        self.table = table
+        self._pending = []
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS "%s" '
+            '(id INTEGER PRIMARY KEY, value INTEGER, line TEXT)' % table)
+    
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM "%s"' % self.table).fetchone()[0]
+    
+    def write(self, lines, value=None):
+        self._pending.extend((value, x) for x in lines)
+    
+    def flush(self):
+        conn, pending, size = (self._conn, self._pending, self.BATCH_SIZE)
+        self._pending = []
+        if pending:
+            sql = 'INSERT INTO "%s" (value, line) VALUES (?, ?)' % self.table
+            conn.execute('BEGIN')
+            try:
+                for i in range(0, len(pending), size):
+                    conn.executemany(sql, pending[i:i + size])
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return conn.execute('SELECT MAX(id) FROM "%s"' % self.table).fetchone()[0] or 0
+    
+    def restore(self, checkpoint):
+        self._conn.execute('DELETE FROM "%s" WHERE id > ?' % self.table, (checkpoint,))
+    
+    def discard(self):
+        self._conn.execute('DELETE FROM "%s"' % self.table)
+    
+    def close(self, commit=True):
+        if self._conn is None:
+            return
+        if commit:
+            self.flush()
+        self._pending = []
+        self._conn.close()
+        self._conn = None
+
+
+try:
+    import fcntl
+
+    def _lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+except ImportError:
+    import msvcrt
+
+    def _lock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class SerialStore(object):
+    """Represents a persistent allocator of serial sequence numbers kept within
+    a local json file. Numbers are leased in blocks while holding an exclusive
+    lock on a companion '.lock' file so processes and threads sharing the file
+    never get overlapping blocks. The state is replaced atomically and synced
+    before a lease is handed out, so numbers once leased are never handed out
+    again after a crash; unused rests of leases returned with `release` are
+    handed out again ahead of fresh numbers.
+    """
+
+    BLOCK_SIZE = 10000
+
+    def __init__(self, path, block_size=None, start=1):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.block_size = (block_size or self.BLOCK_SIZE)
+        self._start = start
+        self._lock = threading.Lock()
+
+    def lease(self, count=None):
+        """Leases a block of numbers and returns it as a (start, stop) range.
+        The block holds `count` numbers, or the block size if not given, but
+        may be shorter when taken from a released rest.
+        """
+        count = (count or self.block_size)
+        if count < 1:
+            raise ValueError("Invalid lease size: %s" % count)
+
+        with self._locked():
+            state = self._load()
+            if state['free']:
+                start, stop = state['free'][0]
+                block = (start, min(stop, start + count))
+                if block[1] == stop:
+                    state['free'].pop(0)
+                else:
+                    state['free'][0] = [block[1], stop]
+            else:
+                block = (state['next'], state['next'] + count)
+                state['next'] = block[1]
+            self._save(state)
+        return block
+
+    def release(self, start, stop):
+        """Hands back the unused rest of a lease."""
+        if start >= stop:
+            return
+
+        with self._locked():
+            state = self._load()
+            free = sorted(state['free'] + [[start, stop]])
+            merged = [free[0]]
+            for block in free[1:]:
+                if block[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], block[1])
+                else:
+                    merged.append(block)
+            state['free'] = merged
+            self._save(state)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {'next': self._start, 'free': []}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _save(self, state):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(self.lock_path, 'a+') as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
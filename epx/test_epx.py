@@ -1,7 +1,22 @@
+import io
+import sys
+import time
 import pytest
+import shutil
 import os.path
+import subprocess
+import xml.etree.ElementTree as ET
 from datetime import datetime
-from epx.core import EPin, Packt, SNGen, EPXEngine
+from epx.core import EPin, Packt, EPinBatch, SNGen, EPXEngine, EPinWriter, ShardSink, \
+                     FileMover, SpillList, \
+                     DirScanner, DirWatcher, CancelToken, HallowIndicator, Progress, \
+                     Instrumentation, SmsFilter, SmsScanner, LeasedSNGen
+from epx.store import PinIndex, SqliteSink, SerialStore
+from dolfin import Storage as _
+import epx.cli
+import epx.report
+import epx.scheduler
+import epx.bench
 
 
 
@@ -28,6 +43,26 @@ def smsfile():
     return open(filename, 'r')
 
 
+def make_smsdir(dirpath, count=6, bad=(2,)):
+    fixture = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+    for i in range(count):
+        target = os.path.join(str(dirpath), 'backup-%02d.xml' % i)
+        if i in bad:
+            with open(target, 'w') as f:
+                f.write('<smses><sms body="Hello there!" /></smses>')
+        else:
+            shutil.copy(fixture, target)
+    return str(dirpath)
+
+
+class StallingEngine(EPXEngine):
+    # kept at module level so it can be shipped to worker processes
+    def _parse_file(self, fullpath):
+        if os.path.basename(fullpath).startswith('stall'):
+            time.sleep(60)
+        return super(StallingEngine, self)._parse_file(fullpath)
+
+
 class TestEPin(object):
 
     def test_construction(self):
@@ -80,6 +115,127 @@ class TestPackt(object):
             count += 1
         assert packt.count == count
 
+    def test_parse_fails_for_message_without_field_labels(self):
+        for message in (None, '', 'Hello there!', 'PIN(s):123 Value:100'):
+            with pytest.raises(ValueError) as exc:
+                Packt.parse(message)
+            assert str(exc.value) == "Message format is invalid."
+    
+    def test_parse_fails_for_malformed_record(self):
+        for message in ('PIN(s):1  Value:100 Qty:1 x', 'Qty:1 PIN(s):1 Value:100 x',
+                        'PIN(s):1 Value:1:0 Qty:1 x'):
+            with pytest.raises(ValueError) as exc:
+                Packt.parse(message)
+            assert str(exc.value) == "Record format in message is invalid."
+    
+    def test_parse_fails_for_non_integer_field_value(self):
+        with pytest.raises(ValueError) as exc:
+            Packt.parse('PIN(s):6673347746062494 Value:1OO Qty:1 x')
+        assert str(exc.value) == "Record field value is invalid: VALUE"
+    
+    def test_parse_accepts_record_at_end_of_message(self):
+        packt = Packt.parse('PIN(s):6673347746062494,6159625120254922, Value:200 Qty:2')
+        assert packt.pins == ('6673347746062494', '6159625120254922')
+        assert (packt.value, packt.quantity) == (200, 2)
+    
+    def test_parse_many_collects_errors_when_list_given(self, packt):
+        message = 'PIN(s):6673347746062494 Value:100 Qty:1 x'
+        errors = []
+        packts = Packt.parse_many([message, 'Hello', message], errors)
+        assert len(packts) == 2
+        assert errors == [(1, "Message format is invalid.")]
+        
+        with pytest.raises(ValueError):
+            Packt.parse_many([message, 'Hello'])
+
+
+class TestEPinBatch(object):
+
+    def test_can_be_created_from_packt(self, packt):
+        batch = EPinBatch.from_packt(packt)
+        assert batch.count == packt.count
+        assert batch.value == packt.value
+        assert list(batch.pins()) == list(packt.pins)
+    
+    def test_yields_same_epins_as_packt(self, packt):
+        batch = EPinBatch.from_packt(packt)
+        assert list(batch) == list(packt)
+        assert all(isinstance(epin, EPin) for epin in batch)
+    
+    def test_keeps_leading_zeros_of_pin_numbers(self):
+        packt = Packt(('0012345678901234',), 100, 1)
+        assert list(EPinBatch.from_packt(packt).pins()) == ['0012345678901234']
+    
+    def test_creation_fails_for_invalid_pin_numbers(self):
+        for pins in (('667334774606249A',), ('667334774606249', '66733477460624941')):
+            with pytest.raises(ValueError):
+                EPinBatch.from_packt(Packt(pins, 100, len(pins)))
+    
+    def test_creation_fails_for_invalid_value(self, packt):
+        with pytest.raises(ValueError):
+            EPinBatch.from_packt(Packt(packt.pins, 105, packt.quantity))
+
+
+class TestSmsFilter(object):
+    
+    def test_marker_is_matched_regardless_of_case(self):
+        sms_filter = SmsFilter()
+        assert sms_filter.accepts('AirtelERC', '1', 'Msg:ERC PIN(s):1234, Value:100')
+        assert not sms_filter.accepts('AirtelERC', '1', 'Hello there!')
+        assert not sms_filter.accepts('AirtelERC', '1', None)
+    
+    def test_address_and_type_are_checked(self):
+        sms_filter = SmsFilter(addresses=['AirtelERC'], types=[1], marker=None)
+        assert sms_filter.accepts('AirtelERC', '1', 'Hello there!')
+        assert not sms_filter.accepts('Friend', '1', 'Hello there!')
+        assert not sms_filter.accepts('AirtelERC', '2', 'Hello there!')
+
+
+class TestSmsScanner(object):
+    
+    def iterparse(self, smsfile):
+        return list(EPXEngine()._iter_sms(smsfile))
+    
+    def test_scan_matches_iterparse_on_fixture(self):
+        filename = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+        messages = list(SmsScanner(filename))
+        assert len(messages) == 2 and messages == self.iterparse(filename)
+        assert messages[0][:2] == ('AirtelERC', '1') and '&amp;' not in messages[0][2]
+    
+    def test_scan_expands_entities_and_normalises_spaces(self, tmpdir):
+        path = str(tmpdir.join('backup.xml'))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("<smses count='4'><!-- <smses> -->\n"
+                    "<sms body='a &gt; b&#10;c\r\nd' type=\"1\" address=\"x\" />\n"
+                    "<sms address=\"y\" type=\"2\" body=\"&lt;fast&gt;\" />\n"
+                    "<sms\taddress=\"\u00e9\" subject=\"a > body='no'\" body=\"&#x263A;&quot;\"/>\n"
+                    "<sms body=\"last\"></sms></smses>")
+        messages = list(SmsScanner(path))
+        assert messages == self.iterparse(path)
+        assert [x[2] for x in messages] == ['a > b\nc d', '<fast>', '\u263a"', 'last']
+    
+    def test_scan_skips_comments_and_cdata(self, tmpdir):
+        path = str(tmpdir.join('backup.xml'))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("<!-- <root> --><smses>\n"
+                    "<!-- <sms body=\"commented\" /> -->\n"
+                    "<sms address=\"x\" type=\"1\" body=\"kept\" />\n"
+                    "<note><![CDATA[ <sms body=\"quoted\" /> ]]></note>\n"
+                    "<sms body=\"last\" /></smses>")
+        messages = list(SmsScanner(path))
+        assert messages == self.iterparse(path)
+        assert [x[2] for x in messages] == ['kept', 'last']
+    
+    def test_scan_reads_in_memory_files(self):
+        smsfile = io.BytesIO(b'<smses><sms body="Hi &amp; bye" /></smses>')
+        assert list(SmsScanner(smsfile)) == [(None, None, 'Hi & bye')]
+    
+    def test_scan_fails_for_empty_file(self, tmpdir):
+        path = tmpdir.join('empty.xml')
+        path.write('')
+        with pytest.raises(ValueError):
+            list(SmsScanner(str(path)))
+
 
 class TestSNGen(object):
     sngen = SNGen()
@@ -115,6 +271,401 @@ class TestSNGen(object):
         with pytest.raises(ValueError):
             SNGen(length=SNGen.MIN_SERIAL_LENGTH - 1)
 
+    def test_reserve_matches_successive_gets(self):
+        timestamp = datetime(2016, 8, 3, 19, 24)
+        sngen1, sngen2 = SNGen(timestamp), SNGen(timestamp)
+        sngen1.get()
+        sngen2.get()
+        block = list(sngen1.reserve(5))
+        assert block == [sngen2.get() for i in range(5)]
+        assert sngen1.current == sngen2.current
+        assert sngen1.get() == sngen2.get()
+    
+    def test_reserve_fails_for_negative_count(self):
+        with pytest.raises(ValueError):
+            SNGen().reserve(-1)
+
+    def test_leased_serials_are_unique_across_generators(self, tmpdir):
+        path = str(tmpdir.join('serials.json'))
+        timestamp = datetime(2016, 8, 3, 19, 24)
+        sngen1 = LeasedSNGen(SerialStore(path, block_size=3), timestamp)
+        sngen2 = LeasedSNGen(SerialStore(path, block_size=3), timestamp)
+        serials = [sngen1.get(), sngen2.get()]
+        serials += list(sngen1.reserve(5)) + list(sngen2.reserve(4))
+        assert len(set(serials)) == len(serials) == 11
+        assert all(len(x) == 20 for x in serials)
+        assert sngen1.current == serials[6]
+    
+    def test_leased_serials_persist_across_restarts(self, tmpdir):
+        path = str(tmpdir.join('serials.json'))
+        timestamp = datetime(2016, 8, 3, 19, 24)
+        sngen = LeasedSNGen(SerialStore(path, block_size=10), timestamp)
+        first = list(sngen.reserve(4))
+        # a crashed run never hands its lease back
+        sngen = LeasedSNGen(SerialStore(path, block_size=10), timestamp)
+        second = list(sngen.reserve(4))
+        assert first[-1].endswith('4') and second[0].endswith('11')
+        sngen.close()
+        
+        sngen = LeasedSNGen(SerialStore(path, block_size=10), timestamp)
+        third = list(sngen.reserve(8))
+        assert [x[-2:] for x in third] == ['15', '16', '17', '18', '19', '20',
+                                           '21', '22']
+        assert not set(first + second) & set(third)
+
+    
+    def test_leased_serials_never_outgrow_their_length(self, tmpdir):
+        store = SerialStore(str(tmpdir.join('serials.json')), start=10 ** 8 - 3)
+        sngen = LeasedSNGen(store)
+        serials = list(sngen.reserve(2)) + [sngen.get()]
+        assert [x[-8:] for x in serials] == ['99999997', '99999998', '99999999']
+        assert all(len(x) == 20 for x in serials)
+        with pytest.raises(ValueError):
+            sngen.reserve(1)
+        with pytest.raises(ValueError):
+            LeasedSNGen(store).get()
+
+
+class TestSerialStore(object):
+    
+    def test_leases_do_not_overlap(self, tmpdir):
+        from concurrent.futures import ThreadPoolExecutor
+        path = str(tmpdir.join('serials.json'))
+        stores = [SerialStore(path, block_size=5) for i in range(2)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            blocks = list(executor.map(lambda i: stores[i % 2].lease(), range(40)))
+        numbers = [n for start, stop in blocks for n in range(start, stop)]
+        assert sorted(numbers) == list(range(1, 201))
+    
+    def test_released_rests_are_leased_again_first(self, tmpdir):
+        store = SerialStore(str(tmpdir.join('serials.json')), block_size=10)
+        assert store.lease() == (1, 11)
+        assert store.lease() == (11, 21)
+        store.release(15, 21)
+        store.release(5, 11)
+        assert store.lease(3) == (5, 8)
+        assert store.lease() == (8, 11)
+        assert store.lease() == (15, 21)
+        assert store.lease() == (21, 31)
+    
+    def test_adjacent_rests_are_merged(self, tmpdir):
+        store = SerialStore(str(tmpdir.join('serials.json')))
+        store.lease(30)
+        store.release(20, 25)
+        store.release(25, 31)
+        assert store.lease(100) == (20, 31)
+    
+    def test_lease_fails_for_non_positive_size(self, tmpdir):
+        with pytest.raises(ValueError):
+            SerialStore(str(tmpdir.join('serials.json'))).lease(-1)
+
+
+class TestDirScanner(object):
+
+    def test_yields_target_files(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=3, bad=())
+        tmpdir.join('notes.txt').write('')
+        scanner = DirScanner(dirpath, '.xml')
+        assert sorted(scanner) == ['backup-%02d.xml' % i for i in range(3)]
+        assert scanner.count == 3 and scanner.done
+    
+    def test_recursive_scan_yields_relative_paths(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        make_smsdir(tmpdir.mkdir('sub'), count=1, bad=())
+        make_smsdir(tmpdir.mkdir('skip'), count=1, bad=())
+        scanner = DirScanner(dirpath, '.xml', recursive=True, exclude={'skip'})
+        assert sorted(scanner) == ['backup-00.xml', os.path.join('sub', 'backup-00.xml')]
+    
+    def test_unreadable_sub_directory_is_noted_and_skipped(self, tmpdir, monkeypatch):
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        make_smsdir(tmpdir.mkdir('locked'), count=1, bad=())
+        make_smsdir(tmpdir.mkdir('open'), count=1, bad=())
+        scandir = os.scandir
+        def fake_scandir(path):
+            if os.path.basename(path) == 'locked':
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+        monkeypatch.setattr(os, 'scandir', fake_scandir)
+        
+        scanner = DirScanner(dirpath, '.xml', recursive=True)
+        assert sorted(scanner) == ['backup-00.xml', os.path.join('open', 'backup-00.xml')]
+        assert len(scanner.errors) == 1
+        assert scanner.errors[0].startswith('Unable to scan directory locked:')
+        
+        result = EPXEngine(recursive=True).process(dirpath)
+        assert len(result.passed) == 2 and result.pins == 20
+        assert [(e.filename, e.smsno) for e in result.errors] == [(None, None)]
+        assert os.path.exists(os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+    
+    def test_summary_counts_dirs_files_and_targets(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=2, bad=())
+        tmpdir.join('notes.txt').write('')
+        tmpdir.mkdir('sub')
+        stats = DirScanner(dirpath, '.xml').summary()
+        assert (stats.dirs, stats.files, stats.targets) == (1, 3, 2)
+    
+    def test_creation_fails_for_invalid_dirpath(self, tmpdir):
+        with pytest.raises(ValueError):
+            DirScanner(str(tmpdir.join('missing')))
+    
+    def test_compressed_scan_yields_compressed_targets_and_archives(self, tmpdir):
+        for name in ['a.xml', 'b.xml.gz', 'c.xml.BZ2', 'd.xml.xz', 'e.zip', 'f.txt.gz']:
+            tmpdir.join(name).write('')
+        assert sorted(DirScanner(str(tmpdir), '.xml')) == ['a.xml']
+        assert sorted(DirScanner(str(tmpdir), '.xml', compressed=True)) == [
+            'a.xml', 'b.xml.gz', 'c.xml.BZ2', 'd.xml.xz', 'e.zip']
+
+
+class TestDirWatcher(object):
+    
+    def test_files_are_handed_out_once_settled(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        watcher = DirWatcher(dirpath, '.xml', settle=2)
+        assert watcher.poll(now=0) == []
+        tmpdir.join('backup-01.xml').write('<smses>')
+        assert watcher.poll(now=2) == ['backup-00.xml']
+        tmpdir.join('backup-01.xml').write('<smses></smses>')
+        assert watcher.poll(now=3) == []
+        assert watcher.poll(now=5) == ['backup-01.xml']
+        assert watcher.poll(now=9) == []
+    
+    def test_changed_files_are_handed_out_again(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=2, bad=())
+        watcher = DirWatcher(dirpath, '.xml', settle=0)
+        watcher.skip(['backup-01.xml'])
+        assert watcher.poll(now=0) == ['backup-00.xml']
+        tmpdir.join('backup-00.xml').write('<smses></smses>')
+        assert watcher.poll(now=1) == ['backup-00.xml']
+
+
+class TestSpillList(object):
+
+    def test_spills_items_beyond_window_to_disk(self):
+        items = SpillList(window=3)
+        items.extend('file-%d.xml' % i for i in range(7))
+        assert len(items) == 7 and len(items._items) == 1
+        assert list(items) == ['file-%d.xml' % i for i in range(7)]
+        
+        items.append('file-7.xml')
+        assert list(items)[-2:] == ['file-6.xml', 'file-7.xml']
+        items.close()
+    
+    def test_appends_after_partial_iteration_are_kept(self):
+        items = SpillList(window=10)
+        items.extend(range(20000))
+        assert next(iter(items)) == 0
+        assert any(x == 5 for x in items)
+        items.extend(range(20000, 20010))
+        assert list(items) == list(range(20010))
+        items.close()
+    
+    def test_reads_back_dict_items_as_storage(self):
+        items = SpillList(window=1)
+        items.append({'filename': 'a.xml', 'smsno': 2, 'error': 'bad'})
+        error = list(items)[0]
+        assert (error.filename, error.smsno, error.error) == ('a.xml', 2, 'bad')
+    
+    def test_truthiness_follows_length(self):
+        assert not SpillList() and SpillList(['a.xml'])
+
+
+class TestEPinWriter(object):
+
+    def test_output_appears_only_on_close(self, tmpdir):
+        path = str(tmpdir.join('epins.txt'))
+        writer = EPinWriter(path, buffer_size=16)
+        writer.write(['line-1', 'line-2'])
+        assert writer.flush() == 14
+        writer.write(['line-3'])
+        assert not os.path.exists(path)
+        
+        writer.close()
+        assert not os.path.exists(writer.part_path)
+        with open(path) as f:
+            assert f.read().splitlines() == ['line-1', 'line-2', 'line-3']
+    
+    def test_close_without_commit_keeps_part_file(self, tmpdir):
+        path = str(tmpdir.join('epins.txt'))
+        writer = EPinWriter(path, fsync=EPinWriter.FSYNC_FLUSH)
+        writer.write(['line-1'])
+        writer.flush()
+        writer.close(commit=False)
+        assert os.path.exists(writer.part_path) and not os.path.exists(path)
+    
+    def test_creation_fails_for_unknown_fsync_policy(self, tmpdir):
+        with pytest.raises(ValueError):
+            EPinWriter(str(tmpdir.join('epins.txt')), fsync='always')
+    
+    def test_compressed_output_can_be_restored_to_checkpoint(self, tmpdir):
+        import gzip
+        path = str(tmpdir.join('epins.txt.gz'))
+        writer = EPinWriter(path, compress=True)
+        writer.write(['line-1', 'line-2'])
+        offset = writer.flush()
+        writer.write(['line-3'])
+        writer.flush()
+        writer.close()
+        
+        writer = EPinWriter(path, compress=True)
+        writer.restore(offset)
+        writer.write(['line-4'])
+        writer.close()
+        with gzip.open(path, 'rt') as f:
+            assert f.read().splitlines() == ['line-1', 'line-2', 'line-4']
+
+
+class TestShardSink(object):
+    
+    def read_shards(self, tmpdir):
+        shards = {}
+        for name in sorted(os.listdir(str(tmpdir))):
+            with open(str(tmpdir.join(name))) as f:
+                shards[name] = f.read().splitlines()
+        return shards
+    
+    def test_shards_by_value(self, tmpdir):
+        sink = ShardSink(str(tmpdir.join('epins.txt')))
+        sink.write(['a', 'b'], 100)
+        sink.write(['c'], 200)
+        sink.write(['d'], 100)
+        assert sink.flush() == {'lines': 0, 'shards': {'epins-100.txt': 6, 'epins-200.txt': 2}}
+        sink.close()
+        assert self.read_shards(tmpdir) == {
+            'epins-100.txt': ['a', 'b', 'd'], 'epins-200.txt': ['c']}
+    
+    def test_shards_by_line_count(self, tmpdir):
+        sink = ShardSink(str(tmpdir.join('epins.txt')), lines=2)
+        sink.write(['a', 'b', 'c'], 100)
+        sink.write(['d', 'e'], 200)
+        sink.close()
+        assert self.read_shards(tmpdir) == {
+            'epins-00001.txt': ['a', 'b'], 'epins-00002.txt': ['c', 'd'],
+            'epins-00003.txt': ['e']}
+    
+    def test_restore_drops_lines_and_shards_after_checkpoint(self, tmpdir):
+        sink = ShardSink(str(tmpdir.join('epins.txt')), lines=2)
+        sink.write(['a', 'b', 'c'], 100)
+        checkpoint = sink.flush()
+        sink.write(['d', 'e'], 100)
+        sink.flush()
+        sink.close()
+        
+        sink = ShardSink(str(tmpdir.join('epins.txt')), lines=2)
+        sink.restore(checkpoint)
+        sink.write(['x'], 100)
+        sink.close()
+        assert self.read_shards(tmpdir) == {
+            'epins-00001.txt': ['a', 'b'], 'epins-00002.txt': ['c', 'x']}
+        
+        tmpdir.join('epins-notes.md').write('')
+        ShardSink(str(tmpdir.join('epins.txt'))).discard()
+        assert os.listdir(str(tmpdir)) == ['epins-notes.md']
+
+
+class TestSqliteSink(object):
+    
+    def test_lines_are_committed_on_flush(self, tmpdir):
+        path = str(tmpdir.join('epins.db'))
+        sink = SqliteSink(path)
+        sink.BATCH_SIZE = 2
+        sink.write(['a', 'b', 'c'], 100)
+        assert len(sink) == 0
+        checkpoint = sink.flush()
+        sink.write(['d'], 200)
+        assert checkpoint == 3 and sink.flush() == 4
+        sink.close()
+        
+        sink = SqliteSink(path)
+        sink.restore(checkpoint)
+        rows = sink._conn.execute('SELECT value, line FROM epins ORDER BY id').fetchall()
+        assert rows == [(100, 'a'), (100, 'b'), (100, 'c')]
+        sink.discard()
+        assert len(sink) == 0
+        sink.close()
+
+
+class TestFileMover(object):
+
+    def test_moves_files_into_destination(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=3, bad=())
+        dirdest = os.path.join(dirpath, '_passed')
+        mover = FileMover(dirpath, dirdest)
+        mover.submit(['backup-00.xml', 'backup-01.xml'])
+        assert mover.close() == []
+        assert sorted(os.listdir(dirdest)) == ['backup-00.xml', 'backup-01.xml']
+        assert os.listdir(dirpath).count('backup-02.xml') == 1
+    
+    def test_reports_per_file_errors(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        mover = FileMover(dirpath, os.path.join(dirpath, '_passed'))
+        mover.submit(['backup-00.xml', 'missing.xml'])
+        errors = mover.close()
+        assert len(errors) == 1 and errors[0].filename == 'missing.xml'
+        assert errors[0].error.startswith('Unable to move file.')
+
+
+class TestProgress(object):
+
+    class Recorder(HallowIndicator):
+        def __init__(self):
+            self.inits, self.updates = ([], [])
+        
+        def init(self, task_count=0, level=0):
+            self.inits.append((task_count, level))
+        
+        def update(self, done=False, task_passed=None, level=0, stats=None):
+            self.updates.append((done, level, dict(stats)))
+    
+    def test_deliveries_are_rate_limited(self):
+        indicator = self.Recorder()
+        progress = Progress(indicator, interval=60)
+        progress.init(1000)
+        for i in range(1000):
+            progress.file_done(True, 5, 1, 100)
+        progress.finish()
+        
+        assert indicator.inits == [(1000, Progress.LEVEL_DIRECTORY)]
+        assert len(indicator.updates) == 2
+        done, level, stats = indicator.updates[-1]
+        assert done and level == Progress.LEVEL_DIRECTORY
+        assert (stats['files'], stats['pins'], stats['bytes']) == (1000, 5000, 100000)
+        assert stats['files_per_sec'] > 0 and stats['eta'] == 0
+    
+    def test_message_offsets_are_reported_at_file_level(self):
+        indicator = self.Recorder()
+        progress = Progress(indicator, interval=0)
+        progress.message(512, 4096)
+        assert indicator.inits == [(4096, Progress.LEVEL_FILE)]
+        assert indicator.updates[0][1] == Progress.LEVEL_FILE
+        assert indicator.updates[0][2]['file_offset'] == 512
+    
+    def test_indicators_with_baseline_signature_keep_working(self, tmpdir):
+        class LegacyIndicator(HallowIndicator):
+            def __init__(self):
+                self.inits, self.updates = ([], [])
+            
+            def init(self, task_count=0, level=0):
+                self.inits.append((task_count, level))
+            
+            def update(self, done=False, task_passed=None):
+                self.updates.append((done, task_passed))
+        
+        indicator = LegacyIndicator()
+        dirpath = make_smsdir(tmpdir, count=3, bad=(1,))
+        result = EPXEngine().process(dirpath, indicator)
+        assert len(result.passed) == 2
+        # the file count is raised as the scan streams in, never per file
+        assert indicator.inits[-1] == (3, Progress.LEVEL_DIRECTORY)
+        assert all(level == Progress.LEVEL_DIRECTORY for x, level in indicator.inits)
+        assert sorted(indicator.updates[:-1]) == [(False, False), (False, True), (False, True)]
+        assert indicator.updates[-1] == (True, None)
+    
+    def test_describe_summarises_stats(self):
+        progress = Progress(interval=0)
+        progress.init(4)
+        progress.file_done(True, 10, 2, 2000000)
+        assert Progress.describe(progress.stats).startswith('1/4 files |')
+
 
 class TestEXPEngine(object):
     engine = EPXEngine()
@@ -123,6 +674,25 @@ class TestEXPEngine(object):
         with pytest.raises(ValueError):
             result = self.engine.process(r'c:\fake-dir')
     
+    def test_process_fails_for_file_path(self):
+        with pytest.raises(ValueError):
+            self.engine.process(os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml'))
+    
+    def test_process_survives_files_vanishing_after_parse(self, tmpdir):
+        class VanishingEngine(EPXEngine):
+            def _parse_file(self, fullpath):
+                parsed = super(VanishingEngine, self)._parse_file(fullpath)
+                if fullpath.endswith(('backup-00.xml', 'backup-01.xml')):
+                    os.remove(fullpath)
+                return parsed
+        
+        dirpath = make_smsdir(tmpdir, count=3, bad=(1,))
+        result = VanishingEngine().process(dirpath)
+        assert sorted(result.passed) == ['backup-00.xml', 'backup-02.xml']
+        assert list(result.failed) == ['backup-01.xml']
+        assert result.pins == 20
+        assert any(e.filename == 'backup-00.xml' for e in result.errors)
+    
     def test_parse_returns_an_iterator(self, smsfile):
         iterobj = self.engine.parse(smsfile)
         assert hasattr(iterobj, '__iter__') == True
@@ -134,6 +704,37 @@ class TestEXPEngine(object):
         assert packt.quantity == packt.count
         assert packt.quantity == 5
     
+    def test_parse_yields_a_packt_per_sms_node(self, smsfile):
+        packts = list(self.engine.parse(smsfile))
+        assert len(packts) == 2
+        assert packts[0].pins[0] == '6673347746062494'
+        assert packts[1].pins[-1] == '6098238800115102'
+    
+    def test_parse_accepts_filepath(self):
+        filename = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+        packts = list(self.engine.parse(filename))
+        assert len(packts) == 2
+    
+    def test_parse_releases_non_sms_siblings(self, tmpdir):
+        import tracemalloc
+        from xml.sax.saxutils import quoteattr
+        body = epx.bench.EPIN_BODY_FORMAT % (','.join(['6673347746062494'] * 5), 100, 5)
+        sms = epx.bench.SMS_FORMAT % {
+            'address': '"AirtelERC"', 'date': 1470248525186, 'body': quoteattr(body)}
+        mms = '<mms><parts><part data="%s" /></parts></mms>\n' % ('A' * 100000)
+        path = str(tmpdir.join('mixed.xml'))
+        with open(path, 'w') as f:
+            f.write('<smses>\n' + sms + mms * 200 + sms + '</smses>')
+        
+        for backend in EPXEngine.BACKENDS:
+            tracemalloc.start()
+            try:
+                packts = list(EPXEngine(backend=backend).parse(path))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            assert len(packts) == 2 and peak < 4 * 1000000
+
     def test_epin_format_output_has_5fields_delimited_by_comma(self, epin):
         line = self.engine._format_epin(epin)
         assert line and ',' in line
@@ -166,3 +767,599 @@ class TestEXPEngine(object):
         today = self.engine.sngen.timestamp.strftime('%d/%m/%Y')
         line = self.engine._format_epin(epin)
         assert line.endswith(today)
+
+    def test_process_with_workers_matches_serial_run(self, tmpdir):
+        outputs = []
+        for workers in (1, 3):
+            dirpath = make_smsdir(tmpdir.mkdir('w%s' % workers))
+            engine = EPXEngine(workers=workers)
+            engine.sngen = SNGen(datetime(2016, 8, 3, 19, 24))
+            result = engine.process(dirpath)
+            with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+                outputs.append((f.read(), list(result.passed), list(result.failed),
+                                [(e.filename, e.smsno, e.error) for e in result.errors]))
+        assert outputs[0] == outputs[1]
+        assert outputs[0][2] == ['backup-02.xml']
+
+    def test_packt_format_matches_per_epin_format(self, packt):
+        timestamp = datetime(2016, 8, 3, 19, 24)
+        engine1, engine2 = EPXEngine(), EPXEngine()
+        engine1.sngen, engine2.sngen = SNGen(timestamp), SNGen(timestamp)
+        lines = engine1._format_packt(packt)
+        assert lines == [engine2._format_epin(epin) for epin in packt]
+        assert lines[0] == '6673347746062494,16080319240000000001,000010000,00000,03/08/2016'
+
+    def test_process_with_pin_index_skips_duplicate_pins(self, tmpdir):
+        index = PinIndex(str(tmpdir.join('pins.db')))
+        engine = EPXEngine(pin_index=index)
+        
+        # two copies of the same backup in one run
+        dirpath = make_smsdir(tmpdir.mkdir('run1'), count=2, bad=())
+        result = engine.process(dirpath)
+        with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+            assert len(f.read().splitlines()) == 10
+        assert result.duplicates == 10 and len(index) == 10
+        
+        # the index persists across runs
+        dirpath = make_smsdir(tmpdir.mkdir('run2'), count=1, bad=())
+        result = engine.process(dirpath)
+        assert result.duplicates == 10 and len(result.passed) == 1
+        assert not os.path.exists(os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+    
+    def test_pin_index_discards_pins_of_failed_files(self, tmpdir, packt):
+        index = PinIndex(str(tmpdir.join('pins.db')))
+        batch = EPinBatch.from_packt(packt)
+        index.savepoint()
+        assert index.filter(batch)[1] == 0
+        index.rollback()
+        assert len(index) == 0
+        
+        index.savepoint()
+        index.filter(batch)
+        index.release()
+        index.close()
+        assert len(PinIndex(index.path)) == packt.count
+
+    def test_process_resumes_from_last_checkpoint(self, tmpdir):
+        class Interrupted(Exception):
+            pass
+        
+        class CrashingEngine(EPXEngine):
+            FLUSH_BYTES = 1
+            def _process_file(self, filename, result, parsed=None):
+                if filename == 'backup-04.xml':
+                    raise Interrupted()
+                return super(CrashingEngine, self)._process_file(
+                    filename, result, parsed)
+        
+        dirpath = make_smsdir(tmpdir, count=6, bad=(2,))
+        with pytest.raises(Interrupted):
+            CrashingEngine().process(dirpath)
+        
+        result = EPXEngine(resume=True).process(dirpath)
+        assert sorted(result.passed) == ['backup-%02d.xml' % i for i in (0, 1, 3, 4, 5)]
+        assert list(result.failed) == ['backup-02.xml'] and len(result.errors) == 1
+        assert sorted(os.listdir(os.path.join(dirpath, '_passed'))) == sorted(result.passed)
+        with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 50 and all(len(l.split(',')) == 5 for l in lines)
+
+    def test_process_resume_after_completed_run_keeps_output(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=3, bad=(1,))
+        outpath = os.path.join(dirpath, EPXEngine.EPINS_FILENAME)
+        EPXEngine().process(dirpath)
+        
+        result = EPXEngine(resume=True).process(dirpath)
+        assert sorted(result.passed) == ['backup-00.xml', 'backup-02.xml']
+        assert list(result.failed) == ['backup-01.xml']
+        with open(outpath) as f:
+            assert len(f.read().splitlines()) == 20
+        
+        shutil.copy(os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml'),
+                    os.path.join(dirpath, 'extra.xml'))
+        result = EPXEngine(resume=True).process(dirpath)
+        assert len(result.passed) == 3 and result.pins == 10
+        with open(outpath) as f:
+            assert len(f.read().splitlines()) == 30
+        
+        # only a run which is not resumed starts afresh
+        result = EPXEngine().process(dirpath)
+        assert not result.passed and not os.path.exists(outpath)
+
+    def test_process_writes_into_custom_sink(self, tmpdir):
+        import functools, gzip
+        dirpath = make_smsdir(tmpdir.mkdir('shards'), count=3, bad=(1,))
+        sink = functools.partial(ShardSink, compress=True)
+        result = EPXEngine(sink=sink).process(dirpath)
+        with gzip.open(os.path.join(dirpath, 'epins-100.txt.gz'), 'rt') as f:
+            assert len(f.read().splitlines()) == result.pins == 20
+        assert not os.path.exists(os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+        
+        dirpath = make_smsdir(tmpdir.mkdir('sqlite'), count=3, bad=(1,))
+        engine = EPXEngine(sink=SqliteSink, epins_filename='epins.db', workers=2)
+        result = engine.process(dirpath)
+        sink = SqliteSink(os.path.join(dirpath, 'epins.db'))
+        assert len(sink) == result.pins == 20
+        sink.close()
+    
+    def test_process_leases_serials_from_store(self, tmpdir):
+        store = SerialStore(str(tmpdir.join('serials.json')), block_size=8)
+        serials = []
+        for name in ('one', 'two'):
+            dirpath = make_smsdir(tmpdir.mkdir(name), count=3, bad=(1,))
+            EPXEngine(serial_store=store, workers=2).process(dirpath)
+            with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+                serials += [x.split(',')[1][-8:] for x in f.read().splitlines()]
+        assert len(serials) == 40
+        assert sorted(int(x) for x in serials) == list(range(1, 41))
+        assert store.lease() == (41, 49)
+
+    def test_process_resumes_into_shards(self, tmpdir):
+        import functools
+        class Interrupted(Exception):
+            pass
+        
+        class CrashingEngine(EPXEngine):
+            FLUSH_BYTES = 1
+            def _process_file(self, filename, result, parsed=None):
+                if filename == 'backup-04.xml':
+                    raise Interrupted()
+                return super(CrashingEngine, self)._process_file(
+                    filename, result, parsed)
+        
+        sink = functools.partial(ShardSink, lines=15)
+        dirpath = make_smsdir(tmpdir, count=6, bad=(2,))
+        with pytest.raises(Interrupted):
+            CrashingEngine(sink=sink).process(dirpath)
+        
+        result = EPXEngine(resume=True, sink=sink).process(dirpath)
+        assert len(result.passed) == 5
+        counts = []
+        for name in sorted(os.listdir(dirpath)):
+            if name.startswith('epins-'):
+                with open(os.path.join(dirpath, name)) as f:
+                    counts.append(len(f.read().splitlines()))
+        assert counts == [15, 15, 15, 5]
+    
+    def test_watch_processes_files_as_they_arrive(self, tmpdir):
+        import threading, time
+        dirpath = make_smsdir(tmpdir, count=2, bad=(1,))
+        cancel, batches = (CancelToken(), [])
+        
+        def on_batch(result):
+            batches.append(result)
+            if len(batches) == 1:
+                make_smsdir(tmpdir, count=3, bad=(0, 1))
+            else:
+                cancel.cancel()
+        
+        engine = EPXEngine()
+        thread = threading.Thread(target=lambda: batches.append(engine.watch(
+            dirpath, interval=0.01, settle=0.05, cancel=cancel, on_batch=on_batch)))
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+        
+        first, second, totals = batches
+        assert sorted(first.passed) == ['backup-00.xml'] and list(first.failed) == ['backup-01.xml']
+        # a rewritten file is picked up again even if it failed before
+        assert list(second.passed) == ['backup-02.xml']
+        assert sorted(second.failed) == ['backup-00.xml', 'backup-01.xml']
+        assert (totals.batches, totals.passed, totals.failed, totals.pins) == (2, 2, 3, 20)
+        with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+            assert len(f.read().splitlines()) == 20
+        with open(os.path.join(dirpath, EPXEngine.REPORT_FILENAME)) as f:
+            assert f.read().count('BATCH ') == 2
+    
+    def test_watch_restart_appends_to_committed_output(self, tmpdir):
+        import functools
+        fixture = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+        for sink, name in ((None, EPXEngine.EPINS_FILENAME),
+                           (functools.partial(ShardSink), 'epins-100.txt')):
+            dirpath = make_smsdir(tmpdir.mkdir(name), count=2, bad=())
+            outpath, seen = (os.path.join(dirpath, name), [])
+            
+            class CheckingEngine(EPXEngine):
+                def _process_file(self, filename, result, parsed=None):
+                    seen.append(os.path.exists(outpath))
+                    return super(CheckingEngine, self)._process_file(
+                        filename, result, parsed)
+            
+            for resume, filename in ((False, None), (True, 'extra-00.xml'),
+                                     (False, 'extra-01.xml')):
+                if filename is not None:
+                    shutil.copy(fixture, os.path.join(dirpath, filename))
+                cancel = CancelToken()
+                totals = CheckingEngine(resume=resume, sink=sink).watch(
+                    dirpath, interval=0.01, settle=0.05, cancel=cancel,
+                    on_batch=lambda result: cancel.cancel())
+                assert totals.passed == (1 if filename else 2)
+            
+            # output committed by earlier sessions stays in place throughout
+            assert seen[2:] == [True, True]
+            with open(outpath) as f:
+                assert len(f.read().splitlines()) == 40
+            assert not os.path.exists(outpath + '.part')
+    
+    def test_watch_batches_take_the_date_they_run_on(self, tmpdir):
+        from datetime import timedelta
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        engine, cancel = (EPXEngine(), CancelToken())
+        engine.sngen = SNGen(datetime.now() - timedelta(days=3))
+        assert engine.line_format
+        engine.watch(dirpath, interval=0.01, settle=0.05, cancel=cancel,
+                     on_batch=lambda result: cancel.cancel())
+        
+        today = datetime.now()
+        with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 10
+        assert all(x.endswith(today.strftime('%d/%m/%Y')) for x in lines)
+        assert all(x.split(',')[1].startswith(today.strftime('%y%m%d')) for x in lines)
+    
+    def test_process_recursive_moves_nested_files(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=1, bad=())
+        make_smsdir(tmpdir.mkdir('sub'), count=2, bad=())
+        result = EPXEngine(recursive=True).process(dirpath)
+        assert len(result.passed) == 3 and not result.errors
+        assert os.path.exists(os.path.join(dirpath, '_passed', 'sub', 'backup-01.xml'))
+
+
+    def test_process_records_stage_timings_when_instrumented(self, tmpdir):
+        calls = []
+        inst = Instrumentation(trace_memory=True, hooks=[lambda *args: calls.append(args)])
+        for workers in (1, 2):
+            dirpath = make_smsdir(tmpdir.mkdir('w%s' % workers), count=3, bad=())
+            engine = EPXEngine(workers=workers, instrumentation=inst)
+            result = engine.process(dirpath)
+            stages = dict((x.stage, x) for x in result.stages)
+            assert [x.stage for x in result.stages] == ['xml', 'packt', 'format', 'write', 'move']
+            assert stages['packt'].calls == 6 and stages['format'].calls == 6
+            assert stages['xml'].bytes == 3 * os.path.getsize(
+                os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml'))
+            assert stages['write'].bytes == os.path.getsize(
+                os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+            assert result.peak_memory > 0 and calls
+            
+            engine.write_report(result)
+            with open(os.path.join(dirpath, EPXEngine.REPORT_FILENAME)) as f:
+                assert 'TIMINGS:' in f.read()
+    
+    def test_process_has_no_stage_timings_by_default(self, tmpdir):
+        result = EPXEngine().process(make_smsdir(tmpdir, count=1, bad=()))
+        assert 'stages' not in result
+    
+    def test_process_skips_sms_rejected_by_filter(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=4, bad=(1, 3))
+        with open(os.path.join(dirpath, 'backup-03.xml'), 'w') as f:
+            f.write('<smses><sms address="Friend" type="1" body="Hi" />'
+                    '<sms address="AirtelERC" type="1" body="PIN(s):12 Value:1" /></smses>')
+        for workers in (1, 2):
+            engine = EPXEngine(workers=workers, sms_filter=SmsFilter())
+            result = engine.process(dirpath)
+            assert result.skipped == 1 and result.pins == 20
+            assert sorted(result.failed) == ['backup-03.xml']
+            assert [(e.smsno, e.error) for e in result.errors] == [
+                (2, "Message format is invalid.")]
+            shutil.rmtree(os.path.join(dirpath, '_passed'))
+            make_smsdir(tmpdir, count=3, bad=(1,))
+    
+    def test_parse_skips_sms_rejected_by_filter(self, smsfile):
+        engine = EPXEngine(sms_filter=SmsFilter(addresses=['Friend']))
+        assert list(engine.parse(smsfile)) == []
+    
+    def test_mmap_backend_output_matches_etree_backend(self, tmpdir):
+        outputs = []
+        for backend in EPXEngine.BACKENDS:
+            dirpath = make_smsdir(tmpdir.mkdir(backend), count=4, bad=(1,))
+            epx.bench.generate_corpus(dirpath, files=3, messages=40, noise=0.2,
+                                     malformed=0.02, seed=3)
+            # a backup cut short fails with both backends, if with other errors
+            fixture = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+            with open(fixture) as f:
+                data = f.read().rstrip()
+            with open(os.path.join(dirpath, 'truncated.xml'), 'w') as f:
+                f.write(data[:-len('</smses>')])
+            engine = EPXEngine(backend=backend, sms_filter=SmsFilter())
+            engine.sngen = SNGen(datetime(2016, 8, 3, 19, 24))
+            result = engine.process(dirpath)
+            with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+                outputs.append((f.read(), sorted(result.passed), result.skipped,
+                                sorted((e.filename, e.smsno, e.error)
+                                       for e in result.errors
+                                       if e.filename != 'truncated.xml'),
+                                [(e.filename, e.smsno) for e in result.errors
+                                 if e.filename == 'truncated.xml']))
+        assert outputs[0] == outputs[1] and outputs[0][0] and outputs[0][3]
+        assert outputs[0][4] == [('truncated.xml', 3)]
+    
+    def test_process_reads_compressed_files_and_archives(self, tmpdir):
+        import gzip, bz2, lzma, zipfile
+        fixture = os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml')
+        with open(fixture, 'rb') as f:
+            data = f.read()
+        dirpath = tmpdir.mkdir('in')
+        for name, opener in [('a.xml.gz', gzip.open), ('b.xml.bz2', bz2.open),
+                             ('c.xml.xz', lzma.open)]:
+            with opener(str(dirpath.join(name)), 'wb') as f:
+                f.write(data)
+        with zipfile.ZipFile(str(dirpath.join('d.zip')), 'w') as archive:
+            archive.writestr('readme.txt', 'not a backup')
+            archive.writestr('x/one.xml', data)
+            archive.writestr('two.xml.gz', gzip.compress(data))
+        with zipfile.ZipFile(str(dirpath.join('e.zip')), 'w') as archive:
+            archive.writestr('readme.txt', 'not a backup')
+        
+        for backend in EPXEngine.BACKENDS:
+            result = EPXEngine(backend=backend).process(str(dirpath))
+            assert result.pins == 50 and list(result.failed) == ['e.zip']
+            assert [e.error for e in result.errors] == ["Archive holds no target files."]
+            assert sorted(os.listdir(str(dirpath.join('_passed')))) == [
+                'a.xml.gz', 'b.xml.bz2', 'c.xml.xz', 'd.zip']
+            for name in os.listdir(str(dirpath.join('_passed'))):
+                shutil.move(str(dirpath.join('_passed', name)), str(dirpath))
+        
+        assert len(list(EPXEngine().parse(str(dirpath.join('d.zip'))))) == 4
+        result = EPXEngine(compressed=False).process(str(dirpath))
+        assert len(result.passed) == len(result.failed) == 0
+    
+    def test_backend_must_be_known(self):
+        with pytest.raises(ValueError):
+            EPXEngine(backend='sax')
+    
+    def test_process_keeps_result_lists_within_window(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=7, bad=(1, 4))
+        engine = EPXEngine()
+        engine.RESULT_WINDOW = 2
+        result = engine.process(dirpath)
+        assert len(result.passed) == 5 and len(result.failed) == 2
+        assert sorted(result.failed) == ['backup-01.xml', 'backup-04.xml']
+        assert sorted(os.listdir(os.path.join(dirpath, '_passed'))) == sorted(result.passed)
+        assert all(e.error == "Message format is invalid." for e in result.errors)
+    
+    def test_process_stops_when_cancelled(self, tmpdir):
+        class CancellingIndicator(HallowIndicator):
+            def update(self, done=False, task_passed=None, level=0, stats=None):
+                if level == Progress.LEVEL_DIRECTORY:
+                    token.cancel()
+        
+        for workers in (1, 2):
+            token = CancelToken()
+            dirpath = make_smsdir(tmpdir.mkdir('w%s' % workers), count=6, bad=())
+            engine = EPXEngine(workers=workers)
+            engine.PROGRESS_INTERVAL = 0
+            result = engine.process(dirpath, CancellingIndicator(), token)
+            assert result.cancelled and len(result.passed) == 1
+            with open(os.path.join(dirpath, EPXEngine.EPINS_FILENAME)) as f:
+                assert len(f.read().splitlines()) == 10
+            
+            # the cancelled run can be resumed
+            result = EPXEngine(resume=True).process(dirpath)
+            assert not result.cancelled and len(result.passed) == 6
+
+    
+    def test_process_cancel_terminates_busy_workers(self, tmpdir):
+        import threading, multiprocessing
+        dirpath = make_smsdir(tmpdir, count=2, bad=())
+        shutil.copy(os.path.join(FIXTURE_DIR, 'sample-smsbackup.xml'),
+                    os.path.join(dirpath, 'stall.xml'))
+        token = CancelToken()
+        threading.Timer(0.5, token.cancel).start()
+        started = time.perf_counter()
+        result = StallingEngine(workers=2).process(dirpath, cancel=token)
+        assert result.cancelled and time.perf_counter() - started < 5
+        assert 'stall.xml' not in result.passed
+        assert not multiprocessing.active_children()
+
+
+class TestReport(object):
+    
+    def test_text_report_streams_spilled_lists_and_errors(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=5, bad=(1, 3))
+        engine = EPXEngine()
+        engine.RESULT_WINDOW = 1
+        result = engine.process(dirpath)
+        engine.write_report(result)
+        with open(os.path.join(dirpath, EPXEngine.REPORT_FILENAME)) as f:
+            report = f.read()
+        assert 'Fail Count: 2\n' in report
+        passed = report.split('PASSED:\n*******\n')[1].split('\n')[0]
+        assert sorted(passed.split(', ')) == ['backup-00.xml', 'backup-02.xml', 'backup-04.xml']
+        assert 'File:  backup-01.xml\nSMS #: ' in report
+        assert report.count('Error: ') == len(result.errors) == 2
+    
+    def test_text_report_marks_empty_sections(self, tmpdir):
+        result = EPXEngine().process(make_smsdir(tmpdir, count=1, bad=()))
+        f = tmpdir.join('report.txt')
+        with open(str(f), 'w') as fp:
+            epx.report.TextReport().write(result, fp)
+        assert 'FAILED:\n*******\n-\n' in f.read()
+    
+    def test_html_report_is_rendered_from_cached_template(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=3, bad=(1,))
+        engine = EPXEngine(report_filename='result.html')
+        result = engine.process(dirpath)
+        result.errors.append(_(filename='<bad>.xml', smsno=None, error='a & b'))
+        engine.write_report(result)
+        with open(os.path.join(dirpath, 'result.html'), encoding='utf-8') as f:
+            report = f.read()
+        assert report.startswith('<!DOCTYPE html>') and report.endswith('</html>')
+        assert '<li>backup-00.xml</li>' in report and '<li>backup-01.xml</li>' in report
+        assert '&lt;bad&gt;.xml' in report and 'a &amp; b' in report
+        template = epx.report.HtmlReport.get_template()
+        assert template is epx.report.HtmlReport.get_template()
+    
+    def test_report_format_must_be_known(self):
+        with pytest.raises(ValueError):
+            EPXEngine(report_format='pdf')
+
+
+class TestScheduler(object):
+    
+    def test_run_processes_each_directory_and_combines_summaries(self, tmpdir):
+        import threading
+        dirpaths = [make_smsdir(tmpdir.mkdir('d%s' % i), count=i + 1, bad=(1,))
+                    for i in range(3)]
+        dirpaths.append(str(tmpdir.join('missing')))
+        release, done = (threading.Event(), [])
+        
+        class SlowEngine(EPXEngine):
+            def process(self, dirpath, indicator=None, cancel=None):
+                # the first directory is held until all others completed
+                if dirpath == dirpaths[0]:
+                    release.wait(10)
+                return super(SlowEngine, self).process(dirpath, indicator, cancel)
+        
+        def on_done(summary):
+            done.append(summary.dirpath)
+            if len(done) == 3:
+                release.set()
+        
+        summary = epx.scheduler.Scheduler(SlowEngine, concurrency=2).run(
+            dirpaths, on_done=on_done)
+        assert done[-1] == dirpaths[0] and len(done) == 4
+        assert [x.dirpath for x in summary.dirs] == dirpaths
+        assert [(x.passed, x.failed) for x in summary.dirs] == [(1, 0), (1, 1), (2, 1), (0, 0)]
+        assert (summary.passed, summary.failed, summary.pins, summary.errors) == (4, 2, 40, 1)
+        assert summary.dirs[3].error == "Provided directory path doesn't exist."
+        for dirpath in dirpaths[:3]:
+            assert os.path.exists(os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+            assert os.path.exists(os.path.join(dirpath, EPXEngine.REPORT_FILENAME))
+    
+    def test_memory_tracing_is_shared_by_overlapping_runs(self, tmpdir):
+        import tracemalloc
+        dirpaths = [make_smsdir(tmpdir.mkdir('d%s' % i), count=2, bad=())
+                    for i in range(4)]
+        factory = lambda: EPXEngine(instrumentation=Instrumentation(trace_memory=True))
+        summary = epx.scheduler.Scheduler(factory, concurrency=4).run(dirpaths)
+        assert summary.passed == 8 and not tracemalloc.is_tracing()
+        
+        first, second = (Instrumentation(trace_memory=True),
+                         Instrumentation(trace_memory=True))
+        first.start()
+        second.start()
+        first.stop()
+        assert tracemalloc.is_tracing()
+        data = [bytearray(1 << 16)]
+        second.stop()
+        assert second.peak_memory >= 1 << 16 and not tracemalloc.is_tracing()
+    
+    def test_interrupt_drops_directories_not_started(self, tmpdir):
+        dirpaths = [make_smsdir(tmpdir.mkdir('d%s' % i), count=2, bad=())
+                    for i in range(4)]
+        def on_done(summary):
+            raise KeyboardInterrupt()
+        
+        with pytest.raises(KeyboardInterrupt):
+            epx.scheduler.Scheduler(concurrency=1).run(dirpaths, on_done=on_done)
+        for dirpath in dirpaths[2:]:
+            assert not os.path.exists(os.path.join(dirpath, EPXEngine.JOURNAL_FILENAME))
+        
+        cancel = CancelToken()
+        summary = epx.scheduler.Scheduler(concurrency=1).run(
+            dirpaths[2:], cancel=cancel, on_done=lambda summary: cancel.cancel())
+        assert summary.cancelled and summary.dirs[1].cancelled
+        assert summary.dirs[1].passed == 0
+    
+    def test_concurrency_must_be_positive(self):
+        with pytest.raises(ValueError):
+            epx.scheduler.Scheduler(concurrency=0)
+
+
+class TestCli(object):
+
+    def test_main_processes_directory_and_writes_report(self, tmpdir, capsys):
+        dirpath = make_smsdir(tmpdir, count=3, bad=())
+        output = str(tmpdir.join('out', 'pins.csv'))
+        os.mkdir(os.path.dirname(output))
+        assert epx.cli.main([dirpath, '-o', output, '-w', '2']) == 0
+        assert 'passed: 3 / failed: 0' in capsys.readouterr().out
+        with open(output) as f:
+            assert len(f.read().splitlines()) == 30
+        assert os.path.exists(os.path.join(dirpath, EPXEngine.REPORT_FILENAME))
+    
+    def test_main_writes_gzipped_shards(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=2, bad=())
+        assert epx.cli.main([dirpath, '-q', '-s', 'shards', '-z', '--shard-lines', '8']) == 0
+        assert sorted(x for x in os.listdir(dirpath) if x.startswith('epins')) == [
+            'epins-00001.txt.gz', 'epins-00002.txt.gz', 'epins-00003.txt.gz']
+    
+    def test_main_writes_sqlite_sink_to_db_file(self, tmpdir):
+        dirpath = make_smsdir(tmpdir, count=2, bad=())
+        assert epx.cli.main([dirpath, '-q', '-s', 'sqlite']) == 0
+        assert not os.path.exists(os.path.join(dirpath, EPXEngine.EPINS_FILENAME))
+        sink = SqliteSink(os.path.join(dirpath, epx.cli.SQLITE_FILENAME))
+        assert len(sink) == 20
+        sink.close()
+    
+    def test_main_processes_many_directories(self, tmpdir, capsys):
+        dirpaths = [make_smsdir(tmpdir.mkdir('d%s' % i), count=2, bad=()) for i in range(3)]
+        summary = str(tmpdir.join('summary.txt'))
+        assert epx.cli.main(dirpaths + ['-j', '2', '--summary', summary]) == 0
+        assert capsys.readouterr().out.count(': passed: 2 / failed: 0') == 3
+        with open(summary) as f:
+            assert 'Pin Count:       60\n' in f.read()
+        with pytest.raises(SystemExit):
+            epx.cli.main(dirpaths + ['--watch'])
+    
+    def test_interrupts_cancel_the_run(self):
+        import signal
+        token = CancelToken()
+        handlers = epx.cli.trap_signals(token)
+        try:
+            os.kill(os.getpid(), signal.SIGINT)
+        finally:
+            epx.cli.restore_signals(handlers)
+        assert token.cancelled
+        assert signal.getsignal(signal.SIGINT) is handlers[signal.SIGINT]
+    
+    def test_marker_switch_leaves_dirpath_alone(self, tmpdir):
+        parser = epx.cli.build_parser()
+        args = parser.parse_args(['-m', str(tmpdir)])
+        assert args.marker == SmsFilter.MARKER and args.dirpaths == [str(tmpdir)]
+        args = parser.parse_args(['--marker-text', 'PIN:', str(tmpdir)])
+        assert args.marker == 'PIN:' and args.dirpaths == [str(tmpdir)]
+        assert parser.parse_args([str(tmpdir)]).marker is None
+    
+    def test_main_fails_for_missing_directory(self, tmpdir):
+        assert epx.cli.main([str(tmpdir.join('missing')), '-q']) == 2
+    
+    def test_cli_does_not_import_gui_modules(self):
+        code = "import sys, epx.cli; print('tkinter' in sys.modules, 'fysom' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', code])
+        assert output.split() == [b'False', b'False']
+    
+    def test_cli_defers_modules_only_some_runs_need(self):
+        code = ("import sys, epx.cli; "
+                "print(*(x in sys.modules for x in ('pathlib', 'tempfile', 'jinja2')))")
+        output = subprocess.check_output([sys.executable, '-c', code])
+        assert output.split() == [b'False', b'False', b'False']
+
+
+class TestBench(object):
+
+    def test_generated_corpus_is_parsed_by_engine(self, tmpdir):
+        paths = epx.bench.generate_corpus(str(tmpdir), files=2, messages=7, pins=3)
+        assert len(paths) == 2
+        packts = list(EPXEngine().parse(paths[0]))
+        assert len(packts) == 7 and all(x.count == x.quantity == 3 for x in packts)
+    
+    def test_generated_corpus_has_noise_and_malformed_messages(self, tmpdir):
+        paths = epx.bench.generate_corpus(
+            str(tmpdir), files=1, messages=200, noise=0.3, malformed=0.2, seed=7)
+        errors = []
+        bodies = [n.attrib['body'] for n in ET.parse(paths[0]).getroot()]
+        Packt.parse_many(bodies, errors)
+        assert 60 < len(errors) < 140
+    
+    def test_process_case_runs_over_a_mixed_corpus(self):
+        metrics = epx.bench.bench_process(2, 20, 3, noise=0.3, malformed=0.0)
+        assert metrics['pins_per_sec'] > 0 and metrics['files_per_sec'] > 0
+        metrics = epx.bench.bench_packt_parse(2, 20, 3, noise=0.3, malformed=0.1)
+        assert metrics['messages_per_sec'] > 0
+    
+    def test_compare_flags_regressions(self):
+        baseline = {'process': {'files_per_sec': 100.0, 'peak_rss': 1000, 'seconds': 1.0}}
+        results = {'process': {'files_per_sec': 85.0, 'peak_rss': 1050, 'seconds': 3.0}}
+        regressions = epx.bench.compare(results, baseline, tolerance=0.1)
+        assert regressions == [('process', 'files_per_sec', 100.0, 85.0)]